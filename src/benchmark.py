@@ -1,10 +1,14 @@
 import random
 from enum import Enum, auto
 import json
+import os
+from array import array
 from pathlib import Path
 
+from benchmark_columnar import read_parquet, write_parquet
 from fact import Fact
 from testcase import TestCase
+from wikidata.utils import prefetch_entities
 
 
 class TestsAxis(Enum):
@@ -34,6 +38,28 @@ class Example:
         self.forward_two_hop_tests = forward_two_hop_tests
         self.prev_storage_tests = prev_storage_tests
 
+    def get_test_cases(self):
+        return self.making_up_tests + self.logical_constraints + self.subject_paraphrasing_tests + \
+            self.two_hop_tests + self.forward_two_hop_tests + self.prev_storage_tests
+
+    def entity_ids(self):
+        ent_ids = self.fact.entity_ids()
+        for test_case in self.get_test_cases():
+            ent_ids.extend(test_case.entity_ids())
+        return ent_ids
+
+    def unresolved_entity_ids(self):
+        ent_ids = self.fact.unresolved_entity_ids()
+        for test_case in self.get_test_cases():
+            ent_ids.extend(test_case.unresolved_entity_ids())
+        return ent_ids
+
+    def resolve(self):
+        self.fact.resolve()
+        for test_case in self.get_test_cases():
+            test_case.resolve()
+        return self
+
     def create_example_dict(self, example_type):
         return {
             'example_type': example_type,
@@ -55,11 +81,11 @@ class Example:
         two_hop_tests = [TestCase.from_dict(test) for test in d['Compositionality_I']]
         forward_two_hop_tests = [TestCase.from_dict(test) for test in d['Compositionality_II']]
         prev_storage_tests = [TestCase.from_dict(test) for test in d['Forgetfulness']]
-        if d['example_type'] in ['random', 'popular']:
+        if d['example_type'] in ['random', 'popular', 'counter_fact']:
             previous_fact = Fact.from_dict(d['edit']['original_fact'])
             return CounterFactualExample(fact, previous_fact, making_up_tests, logical_constraints,
                                          subject_paraphrasing_tests, two_hop_tests, forward_two_hop_tests, prev_storage_tests)
-        elif d['example_type'] == 'recent':
+        elif d['example_type'] in ['recent', 'recently_added_fact']:
             return RecentlyAddedExample(fact, making_up_tests, logical_constraints, subject_paraphrasing_tests,
                                         two_hop_tests, forward_two_hop_tests, prev_storage_tests)
         else:
@@ -118,6 +144,17 @@ class CounterFactualExample(Example):
         )
         self.previous_fact = previous_fact
 
+    def entity_ids(self):
+        return super().entity_ids() + self.previous_fact.entity_ids()
+
+    def unresolved_entity_ids(self):
+        return super().unresolved_entity_ids() + self.previous_fact.unresolved_entity_ids()
+
+    def resolve(self):
+        super().resolve()
+        self.previous_fact.resolve()
+        return self
+
     def to_dict(self):
         d = super().create_example_dict('counter_fact')
         d['edit']['original_fact'] = self.previous_fact.to_dict()
@@ -159,18 +196,145 @@ class Dataset:
     def __init__(self, examples: list):
         self.examples = examples
 
+    def __len__(self):
+        return len(self.examples)
+
+    def __iter__(self):
+        return iter(self.examples)
+
+    def __getitem__(self, i):
+        return self.examples[i]
+
     def sample(self, k: int):
         return random.sample(self.examples, min(k, len(self.examples)))
 
+    def entity_ids(self):
+        ent_ids = set()
+        for example in self.examples:
+            ent_ids.update(example.entity_ids())
+        return ent_ids
+
+    def resolve_entities(self, batch_size: int = 50, max_workers: int = 4):
+        # Prefetches the entities in batches, then captures labels and answers so serializing needs no lookups. Only
+        # the entities of prompts and answers not loaded yet are fetched, so a loaded dataset needs no requests.
+        ent_ids = set()
+        for example in self.examples:
+            ent_ids.update(example.unresolved_entity_ids())
+        fetched = prefetch_entities(ent_ids, batch_size, max_workers) if ent_ids else 0
+        for example in self.examples:
+            example.resolve()
+        return fetched
+
     def to_file(self, filename):
         p = Path(filename)
         p.parent.mkdir(parents=True, exist_ok=True)
+        if p.suffix == '.jsonl':
+            with JsonlDatasetWriter(filename) as writer:
+                for example in self.examples:
+                    writer.write(example)
+            return
+        if p.suffix == '.parquet':
+            write_parquet([example.to_dict() for example in self.examples], filename)
+            return
         d = [example.to_dict() for example in self.examples]
         with p.open('w+', encoding='utf-8') as f:
             json.dump(d, f, ensure_ascii=False, indent=2)
 
     @staticmethod
     def from_file(filename):
+        if Path(filename).suffix == '.jsonl':
+            return Dataset(list(JsonlDataset(filename)))
+        if Path(filename).suffix == '.parquet':
+            return Dataset.from_parquet(filename)
         with open(filename, 'r', encoding='utf-8') as f:
             examples = json.load(f)
         return Dataset([Example.from_dict(example) for example in examples])
+
+    @staticmethod
+    def from_parquet(filename, example_types: list = None, relations: list = None, axes: list = None):
+        # Only the row groups matching the given example types, edit relations and test axes are decoded
+        example_dicts = read_parquet(filename, example_types, relations, axes)
+        return Dataset([Example.from_dict(example) for example in example_dicts])
+
+    @staticmethod
+    def open(filename):
+        if Path(filename).suffix == '.jsonl':
+            return JsonlDataset(filename)
+        return Dataset.from_file(filename)
+
+
+class JsonlDataset:
+
+    INDEX_SUFFIX = '.idx'
+
+    def __init__(self, filename):
+        self._filename = filename
+        self._index_filename = filename + self.INDEX_SUFFIX
+        self._offsets = self._load_offsets()
+
+    def _load_offsets(self):
+        # The sidecar index holds the offset of every line followed by the file size, it is rebuilt if stale
+        file_size = os.path.getsize(self._filename)
+        offsets = array('Q')
+        if os.path.isfile(self._index_filename):
+            with open(self._index_filename, 'rb') as f:
+                offsets.frombytes(f.read())
+            if offsets and offsets[-1] == file_size:
+                return offsets
+        offsets = array('Q')
+        with open(self._filename, 'rb') as f:
+            offset = 0
+            for line in f:
+                if line.strip():
+                    offsets.append(offset)
+                offset += len(line)
+        offsets.append(file_size)
+        with open(self._index_filename, 'wb') as f:
+            f.write(offsets.tobytes())
+        return offsets
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __iter__(self):
+        with open(self._filename, 'r', encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    yield Example.from_dict(json.loads(line))
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        with open(self._filename, 'rb') as f:
+            f.seek(self._offsets[i])
+            return Example.from_dict(json.loads(f.readline().decode('utf-8')))
+
+    def sample(self, k: int):
+        return [self[i] for i in random.sample(range(len(self)), min(k, len(self)))]
+
+
+class JsonlDatasetWriter:
+
+    def __init__(self, filename):
+        self._filename = filename
+        Path(filename).parent.mkdir(parents=True, exist_ok=True)
+        self._file = open(filename, 'wb')
+        self._offsets = array('Q')
+
+    def write(self, example):
+        self._offsets.append(self._file.tell())
+        self._file.write((json.dumps(example.to_dict(), ensure_ascii=False) + '\n').encode('utf-8'))
+
+    def close(self):
+        self._offsets.append(self._file.tell())
+        self._file.close()
+        with open(self._filename + JsonlDataset.INDEX_SUFFIX, 'wb') as f:
+            f.write(self._offsets.tobytes())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,189 @@
+import argparse
+import json
+from pathlib import Path
+
+
+# One row per query, with the edit (and original fact) of every example stored as rows of their own axes.
+# Example level columns are repeated on every row, so filtering by them keeps whole examples. A test case without
+# any queries is kept as a single row without a role.
+EDIT_AXIS = 'edit'
+ORIGINAL_FACT_AXIS = 'original_fact'
+TEST_AXES = ['Relation_Specificity', 'Logical_Generalization', 'Subject_Aliasing',
+             'Compositionality_I', 'Compositionality_II', 'Forgetfulness']
+TEST_ROLE = 'test'
+CONDITION_ROLE = 'condition'
+
+_DICTIONARY_COLUMNS = ['example_type', 'edit_relation', 'axis', 'test_condition', 'role', 'query_type',
+                       'prompt', 'subject_id', 'relation', 'target_ids', 'phrase', 'second_relation',
+                       'second_hop_target_ids']
+_INT_COLUMNS = ['example_index', 'test_index', 'query_index']
+_COLUMNS = _INT_COLUMNS + _DICTIONARY_COLUMNS + ['answers']
+
+
+def _schema():
+    import pyarrow as pa
+
+    fields = [pa.field(column, pa.int32()) for column in _INT_COLUMNS]
+    fields += [pa.field(column, pa.dictionary(pa.int32(), pa.string())) for column in _DICTIONARY_COLUMNS]
+    fields.append(pa.field('answers', pa.list_(pa.struct([('value', pa.string()),
+                                                          ('aliases', pa.list_(pa.string()))]))))
+    return pa.schema(fields)
+
+
+def _encode_ids(ids):
+    # Targets may be entity ids or literal values, json keeps their types through the round trip
+    return None if ids is None else json.dumps(ids, ensure_ascii=False)
+
+
+def _decode_ids(ids):
+    return None if ids is None else json.loads(ids)
+
+
+def example_dicts_to_columns(example_dicts):
+    columns = {column: [] for column in _COLUMNS}
+
+    def add_row(example_index, example_dict, axis, test_index=None, test_condition=None, role=None,
+                query_index=None, query=None, fact=None):
+        columns['example_index'].append(example_index)
+        columns['example_type'].append(example_dict['example_type'])
+        columns['edit_relation'].append(example_dict['edit']['relation'])
+        columns['axis'].append(axis)
+        columns['test_index'].append(test_index)
+        columns['test_condition'].append(test_condition)
+        columns['role'].append(role)
+        columns['query_index'].append(query_index)
+        if fact is not None:
+            columns['query_type'].append(None)
+            columns['prompt'].append(fact['prompt'])
+            columns['subject_id'].append(fact['subject_id'])
+            columns['relation'].append(fact['relation'])
+            columns['target_ids'].append(_encode_ids(fact['target_id']))
+            columns['phrase'].append(None)
+            columns['second_relation'].append(None)
+            columns['second_hop_target_ids'].append(None)
+            columns['answers'].append(None)
+        elif query is None:
+            for column in ['query_type', 'prompt', 'subject_id', 'relation', 'target_ids', 'phrase',
+                           'second_relation', 'second_hop_target_ids', 'answers']:
+                columns[column].append(None)
+        else:
+            columns['query_type'].append(query['query_type'])
+            columns['prompt'].append(query['prompt'])
+            columns['subject_id'].append(query['subject_id'])
+            columns['relation'].append(query['relation'])
+            columns['target_ids'].append(_encode_ids(query['target_ids']))
+            columns['phrase'].append(query['phrase'])
+            columns['second_relation'].append(query.get('second_relation'))
+            columns['second_hop_target_ids'].append(_encode_ids(query.get('second_hop_target_ids')))
+            columns['answers'].append(query['answers'])
+
+    for example_index, example_dict in enumerate(example_dicts):
+        add_row(example_index, example_dict, EDIT_AXIS, fact=example_dict['edit'])
+        if 'original_fact' in example_dict['edit']:
+            add_row(example_index, example_dict, ORIGINAL_FACT_AXIS, fact=example_dict['edit']['original_fact'])
+        for axis in TEST_AXES:
+            for test_index, test in enumerate(example_dict[axis]):
+                if not test['test_queries'] and not test['condition_queries']:
+                    add_row(example_index, example_dict, axis, test_index, test['test_condition'])
+                for role, queries in [(TEST_ROLE, test['test_queries']), (CONDITION_ROLE, test['condition_queries'])]:
+                    for query_index, query in enumerate(queries):
+                        add_row(example_index, example_dict, axis, test_index, test['test_condition'], role,
+                                query_index, query)
+    return columns
+
+
+def _fact_dict(row):
+    return {
+        'prompt': row['prompt'],
+        'subject_id': row['subject_id'],
+        'relation': row['relation'],
+        'target_id': _decode_ids(row['target_ids']),
+    }
+
+
+def _query_dict(row):
+    d = {
+        'prompt': row['prompt'],
+        'answers': row['answers'],
+        'query_type': row['query_type'],
+        'subject_id': row['subject_id'],
+        'relation': row['relation'],
+        'target_ids': _decode_ids(row['target_ids']),
+        'phrase': row['phrase'],
+    }
+    if row['query_type'] == 'two_hop':
+        d['second_relation'] = row['second_relation']
+        d['second_hop_target_ids'] = _decode_ids(row['second_hop_target_ids'])
+    return d
+
+
+def columns_to_example_dicts(columns):
+    examples = dict()
+    tests = dict()
+    original_facts = dict()
+    for values in zip(*[columns[column] for column in _COLUMNS]):
+        row = dict(zip(_COLUMNS, values))
+        example_index = row['example_index']
+        if example_index not in examples:
+            examples[example_index] = {'example_type': row['example_type'], 'edit': None}
+            for axis in TEST_AXES:
+                examples[example_index][axis] = []
+        example = examples[example_index]
+        if row['axis'] == EDIT_AXIS:
+            example['edit'] = _fact_dict(row)
+        elif row['axis'] == ORIGINAL_FACT_AXIS:
+            original_facts[example_index] = _fact_dict(row)
+        else:
+            key = (example_index, row['axis'], row['test_index'])
+            if key not in tests:
+                tests[key] = {'test_queries': [], 'test_condition': row['test_condition'], 'condition_queries': []}
+                example[row['axis']].append(tests[key])
+            if row['role'] is None:
+                continue
+            role_key = 'test_queries' if row['role'] == TEST_ROLE else 'condition_queries'
+            tests[key][role_key].append(_query_dict(row))
+    for example_index, original_fact in original_facts.items():
+        examples[example_index]['edit']['original_fact'] = original_fact
+    return list(examples.values())
+
+
+def write_parquet(example_dicts, filename, row_group_size: int = 100000):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    Path(filename).parent.mkdir(parents=True, exist_ok=True)
+    table = pa.Table.from_pydict(example_dicts_to_columns(example_dicts), schema=_schema())
+    pq.write_table(table, filename, row_group_size=row_group_size, compression='zstd')
+
+
+def parquet_filters(example_types: list = None, relations: list = None, axes: list = None):
+    filters = []
+    if example_types is not None:
+        filters.append(('example_type', 'in', list(example_types)))
+    if relations is not None:
+        filters.append(('edit_relation', 'in', list(relations)))
+    if axes is not None:
+        # The edit rows are always read, since the examples can not be decoded without them
+        filters.append(('axis', 'in', list(axes) + [EDIT_AXIS, ORIGINAL_FACT_AXIS]))
+    return filters or None
+
+
+def read_parquet(filename, example_types: list = None, relations: list = None, axes: list = None):
+    import pyarrow.parquet as pq
+
+    table = pq.read_table(filename, columns=_COLUMNS, filters=parquet_filters(example_types, relations, axes))
+    columns = {column: table.column(column).to_pylist() for column in _COLUMNS}
+    return columns_to_example_dicts(columns)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input', help='The benchmark json to convert')
+    parser.add_argument('--output', help='The parquet path')
+    args = parser.parse_args()
+
+    with open(args.input, 'r', encoding='utf-8') as f:
+        example_dicts = json.load(f)
+    write_parquet(example_dicts, args.output)
+    assert read_parquet(args.output) == example_dicts
+    print(f'Converted {len(example_dicts)} examples to {args.output}')
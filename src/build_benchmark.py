@@ -1,7 +1,13 @@
 import json
 import random
+import time
+import multiprocessing
+import traceback
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from wikidata.utils import get_label, load_json, ent_label2id, subject_relation_to_targets, ent_to_relation_ids
 from wikidata.relations import our_relations
+from wikidata.optional_targets import OptionalTargetsIndex, OPTIONAL_TARGETS_INDEX_PATH, OPTIONAL_TARGETS_JSON_PATH
 from wikidata.recently_modified_facts import recently_modified_facts_given_relation
 from build_benchmark_tests import \
     making_up_axis, \
@@ -12,7 +18,8 @@ from build_benchmark_tests import \
     temporal_axis
 from relation import Relation
 from fact import Fact
-from benchmark import CounterFactualExample, RecentlyAddedExample, Dataset
+from benchmark import Example, CounterFactualExample, RecentlyAddedExample, Dataset
+from build_checkpoint import BuildCheckpoint
 from queryexecutor import QueryExecutor
 
 
@@ -36,82 +43,166 @@ def construct_counterfactuals_benchmark():
     return Dataset(dataset_list)
 
 
-def construct_recently_modified_benchmark(size: int = None):
-    current_data = load_json('./generations/uniformly_from_recent_days_recently_modified_dataset.json')
-    if size is not None:
-        current_data = random.sample(current_data, min(size, len(current_data)))
-    dataset_list = []
-    i = 0
-    for subject_id, relation_id, target_id in current_data:
-        relation_enum = Relation.id_to_enum(relation_id)
-        if relation_enum is None:
-            continue
-        try:
-            dataset_list.append(build_recently_modified_dataset_example(subject_id, relation_enum, target_id))
-        except:
-            continue
-        i += 1
-        if i % 100 == 0:
-            print(f'Built {i}/{len(current_data)}')
-    return Dataset(dataset_list)
+class AxisBuildError(Exception):
+
+    def __init__(self, failures: dict):
+        super().__init__(f'Failed building axes: {", ".join(failures.keys())}')
+        self.failures = failures
 
 
-def build_recently_modified_dataset_example(subject_id: str, relation: Relation, target_id: str):
+def build_axes(axis_calls: dict, num_threads: int = 1):
+    axes, failures = dict(), dict()
+    if num_threads <= 1:
+        for axis, (axis_function, args) in axis_calls.items():
+            try:
+                axes[axis] = axis_function(*args)
+            except Exception:
+                failures[axis] = traceback.format_exc()
+    else:
+        with ThreadPoolExecutor(max_workers=num_threads) as executor:
+            futures = {axis: executor.submit(axis_function, *args) for axis, (axis_function, args) in axis_calls.items()}
+            for axis, future in futures.items():
+                try:
+                    axes[axis] = future.result()
+                except Exception:
+                    failures[axis] = traceback.format_exc()
+    if failures:
+        raise AxisBuildError(failures)
+    return axes
+
+
+def _build_example_task(task):
+    build_function, args, seed, num_threads, as_dict = task
+    random.seed(seed)
+    try:
+        example = build_function(*args, num_threads=num_threads)
+        return (example.to_dict() if as_dict else example), dict()
+    except AxisBuildError as e:
+        print(f'Failed building example for {args}: {e}')
+        return None, e.failures
+    except Exception as e:
+        print(f'Failed building example for {args}: {e!r}')
+        return None, {'example': traceback.format_exc()}
+
+
+def build_examples_in_parallel(build_function, args_list: list, num_processes: int = 1, num_threads: int = 1,
+                               seed: int = 0, log_every: int = 100, checkpoint: BuildCheckpoint = None):
+    first_task = 0
+    if checkpoint is not None:
+        if checkpoint.exists():
+            checkpoint.load()
+            if checkpoint.build_function_name() != build_function.__name__:
+                raise Exception(f'Checkpoint was created by {checkpoint.build_function_name()}')
+            args_list, seed, first_task = checkpoint.tasks(), checkpoint.seed(), checkpoint.completed()
+        else:
+            checkpoint.start(build_function.__name__, args_list, seed)
+    tasks = [(build_function, args_list[i], seed + i, num_threads, checkpoint is not None)
+             for i in range(first_task, len(args_list))]
+
+    examples = []
+    failure_counts = defaultdict(int)
+    start_time = time.time()
+    pool = None
+    if num_processes > 1:
+        pool = multiprocessing.get_context('spawn').Pool(num_processes)
+        results = pool.imap(_build_example_task, tasks)
+    else:
+        results = map(_build_example_task, tasks)
+    try:
+        for i, (example, failures) in enumerate(results):
+            if checkpoint is not None:
+                checkpoint.record(first_task + i, example, failures)
+            else:
+                examples.append(example)
+            for axis in failures:
+                failure_counts[axis] += 1
+            if (i + 1) % log_every == 0:
+                elapsed = time.time() - start_time
+                print(f'Built {first_task + i + 1}/{len(args_list)} ({(i + 1) / elapsed:.2f} examples/sec)')
+    finally:
+        if checkpoint is not None:
+            checkpoint.save()
+        if pool is not None:
+            pool.close()
+            pool.join()
+    elapsed = time.time() - start_time
+    print(f'Built {len(tasks)} examples in {elapsed:.1f} seconds '
+          f'({len(tasks) / elapsed if elapsed else 0.0:.2f} examples/sec)')
+
+    if checkpoint is not None:
+        failure_counts = checkpoint.failure_counts()
+        examples = [Example.from_dict(example_dict) for example_dict in checkpoint.example_dicts()]
+    if failure_counts:
+        print('Failures per axis: ' + ', '.join(f'{axis}: {count}' for axis, count in failure_counts.items()))
+    return examples
+
+
+def construct_recently_modified_benchmark(size: int = None, num_processes: int = 1, num_threads: int = 1,
+                                          seed: int = 0, checkpoint_dir: str = None):
+    checkpoint = BuildCheckpoint(checkpoint_dir) if checkpoint_dir is not None else None
+    examples_args = []
+    if checkpoint is None or not checkpoint.exists():
+        random.seed(seed)
+        current_data = load_json('./generations/uniformly_from_recent_days_recently_modified_dataset.json')
+        if size is not None:
+            current_data = random.sample(current_data, min(size, len(current_data)))
+        for subject_id, relation_id, target_id in current_data:
+            relation_enum = Relation.id_to_enum(relation_id)
+            if relation_enum is None:
+                continue
+            examples_args.append((subject_id, relation_enum, target_id))
+    examples = build_examples_in_parallel(build_recently_modified_dataset_example, examples_args,
+                                          num_processes, num_threads, seed, checkpoint=checkpoint)
+    return Dataset([example for example in examples if example is not None])
+
+
+def build_recently_modified_dataset_example(subject_id: str, relation: Relation, target_id: str,
+                                            num_threads: int = 1):
     fact = Fact(subject_id, relation, target_id)
-    making_up_tests = making_up_axis(subject_id, relation)
-    logical_constraints = logical_constraints_axis(subject_id, relation, target_id)
-    subject_aliasing_tests = subject_aliasing_axis(subject_id, relation, target_id)
-    two_hop_tests = two_hop_axis(subject_id, relation, target_id)
-    forward_two_hop_tests = forward_two_hop_axis(subject_id, relation, target_id)
-    curr_example = RecentlyAddedExample(
-        fact=fact,
-        making_up_tests=making_up_tests,
-        logical_constraints=logical_constraints,
-        subject_paraphrasing_tests=subject_aliasing_tests,
-        two_hop_tests=two_hop_tests,
-        forward_two_hop_tests=forward_two_hop_tests,
-    )
+    axes = build_axes({
+        'making_up_tests': (making_up_axis, (subject_id, relation)),
+        'logical_constraints': (logical_constraints_axis, (subject_id, relation, target_id)),
+        'subject_paraphrasing_tests': (subject_aliasing_axis, (subject_id, relation, target_id)),
+        'two_hop_tests': (two_hop_axis, (subject_id, relation, target_id)),
+        'forward_two_hop_tests': (forward_two_hop_axis, (subject_id, relation, target_id)),
+    }, num_threads)
+    curr_example = RecentlyAddedExample(fact=fact, **axes)
     return curr_example
 
 
-def construct_fake_edits_benchmark(facts: list):
-    dataset_list = []
-    cnt = 0
-    for subject_id, relation, target_id in facts:
-        relation2optional_targets = load_json('./wikidata/relation2optional_targets_new.json')
-        relation_formal_name = relation.formal_name()
-        if relation_formal_name not in relation2optional_targets:
-            continue
-        optional_targets = relation2optional_targets[relation.formal_name()]
-        random_target_id = ent_label2id(random.sample(optional_targets, 1)[0])
-        if random_target_id is None:
-            continue
-        dataset_list.append(build_fake_dataset_example(subject_id, relation, random_target_id, target_id))
-        cnt += 1
-        if cnt % 100 == 0:
-            print(f'{cnt}/{len(facts)}')
-    return Dataset(dataset_list)
+def construct_fake_edits_benchmark(facts: list, num_processes: int = 1, num_threads: int = 1, seed: int = 0,
+                                   checkpoint_dir: str = None):
+    checkpoint = BuildCheckpoint(checkpoint_dir) if checkpoint_dir is not None else None
+    examples_args = []
+    if checkpoint is None or not checkpoint.exists():
+        random.seed(seed)
+        optional_targets_index = OptionalTargetsIndex.load(OPTIONAL_TARGETS_INDEX_PATH, OPTIONAL_TARGETS_JSON_PATH)
+        for subject_id, relation, target_id in facts:
+            relation_formal_name = relation.formal_name()
+            if relation_formal_name not in optional_targets_index:
+                continue
+            random_target_id = ent_label2id(optional_targets_index.sample(relation_formal_name))
+            if random_target_id is None:
+                continue
+            examples_args.append((subject_id, relation, random_target_id, target_id))
+    examples = build_examples_in_parallel(build_fake_dataset_example, examples_args, num_processes, num_threads, seed,
+                                          checkpoint=checkpoint)
+    return Dataset([example for example in examples if example is not None])
 
 
-def build_fake_dataset_example(subject_id: str, relation: Relation, target_id: str, previous_target_id: str):
+def build_fake_dataset_example(subject_id: str, relation: Relation, target_id: str, previous_target_id: str,
+                               num_threads: int = 1):
     fact = Fact(subject_id, relation, target_id)
     previous_fact = Fact(subject_id, relation, previous_target_id)
-    making_up_tests = making_up_axis(subject_id, relation)
-    logical_constraints = logical_constraints_axis(subject_id, relation, target_id)
-    subject_aliasing_tests = subject_aliasing_axis(subject_id, relation, target_id)
-    two_hop_tests = two_hop_axis(subject_id, relation, target_id)
-    forward_two_hop_tests = forward_two_hop_axis(subject_id, relation, target_id)
-    temporal_tests = temporal_axis(subject_id, relation, previous_target_id)
-    curr_example = CounterFactualExample(
-        fact=fact,
-        previous_fact=previous_fact,
-        making_up_tests=making_up_tests,
-        logical_constraints=logical_constraints,
-        subject_paraphrasing_tests=subject_aliasing_tests,
-        two_hop_tests=two_hop_tests,
-        forward_two_hop_tests=forward_two_hop_tests,
-        prev_storage_tests=temporal_tests,
-    )
+    axes = build_axes({
+        'making_up_tests': (making_up_axis, (subject_id, relation)),
+        'logical_constraints': (logical_constraints_axis, (subject_id, relation, target_id)),
+        'subject_paraphrasing_tests': (subject_aliasing_axis, (subject_id, relation, target_id)),
+        'two_hop_tests': (two_hop_axis, (subject_id, relation, target_id)),
+        'forward_two_hop_tests': (forward_two_hop_axis, (subject_id, relation, target_id)),
+        'prev_storage_tests': (temporal_axis, (subject_id, relation, previous_target_id)),
+    }, num_threads)
+    curr_example = CounterFactualExample(fact=fact, previous_fact=previous_fact, **axes)
     return curr_example
 
 
@@ -160,7 +251,11 @@ def sample_relevant_facts_given_list_of_subjects(subjects: list, number_of_facts
 
 
 def construct_fake_dataset_based_on_top_views_file(limit: int = None, facts_limit: int = None,
-                                                   limit_subjects: int = None, limit_num_of_facts: int = None):
+                                                   limit_subjects: int = None, limit_num_of_facts: int = None,
+                                                   num_processes: int = 1, num_threads: int = 1, seed: int = 0,
+                                                   checkpoint_dir: str = None):
+    if checkpoint_dir is not None and BuildCheckpoint(checkpoint_dir).exists():
+        return construct_fake_edits_benchmark([], num_processes, num_threads, seed, checkpoint_dir)
     subjects_json = load_json('./wikidata/top_entities_by_views_monthly.json')
     subject_list = []
     for month, subjects in subjects_json.items():
@@ -177,12 +272,16 @@ def construct_fake_dataset_based_on_top_views_file(limit: int = None, facts_limi
     print('building dataset..')
     random.shuffle(all_relevant_facts)
     all_relevant_facts = random.sample(all_relevant_facts, min(limit, len(all_relevant_facts)))
-    dataset = construct_fake_edits_benchmark(all_relevant_facts)
+    dataset = construct_fake_edits_benchmark(all_relevant_facts, num_processes, num_threads, seed, checkpoint_dir)
     return dataset
 
 
 def construct_fake_dataset_based_on_sampled_buckets(path: str, limit: int, facts_limit: int = None,
-                                                   limit_subjects: int = None, limit_num_of_facts: int = None):
+                                                   limit_subjects: int = None, limit_num_of_facts: int = None,
+                                                   num_processes: int = 1, num_threads: int = 1, seed: int = 0,
+                                                   checkpoint_dir: str = None):
+    if checkpoint_dir is not None and BuildCheckpoint(checkpoint_dir).exists():
+        return construct_fake_edits_benchmark([], num_processes, num_threads, seed, checkpoint_dir)
     subjects_json = load_json(path)
     subject_list = []
     for bucket in subjects_json:
@@ -199,7 +298,7 @@ def construct_fake_dataset_based_on_sampled_buckets(path: str, limit: int, facts
     print('building dataset..')
     random.shuffle(all_relevant_facts)
     all_relevant_facts = random.sample(all_relevant_facts, min(limit, len(all_relevant_facts)))
-    dataset = construct_fake_edits_benchmark(all_relevant_facts)
+    dataset = construct_fake_edits_benchmark(all_relevant_facts, num_processes, num_threads, seed, checkpoint_dir)
     return dataset
         
 
@@ -230,6 +329,7 @@ if __name__ == '__main__':
 
     # recently_modified_size = 2000
     # recently_modified_benchmark = construct_recently_modified_benchmark(recently_modified_size)
+    # recently_modified_benchmark.resolve_entities()
     # recently_modified_benchmark.to_file(f'./benchmark/final/recently_modified_{recently_modified_size}.json')
 
     # for example in recently_modified_facts.sample(5):
@@ -249,13 +349,17 @@ if __name__ == '__main__':
     # top_views_benchmark = construct_fake_dataset_based_on_top_views_file(
     #     limit=top_views_size, facts_limit=10000, limit_num_of_facts=3, limit_subjects=100000
     # )
+    # top_views_benchmark.resolve_entities()
     # top_views_benchmark.to_file(f'./benchmark/final/top_views_{top_views_size}.json')
 
     fake_size = 2000
     fake_benchmark = construct_fake_dataset_based_on_sampled_buckets(
         path='./generations/sampled_entities_divided_to_buckets_5000.json',
-        limit=fake_size, facts_limit=15000, limit_num_of_facts=4, limit_subjects=100000
+        limit=fake_size, facts_limit=15000, limit_num_of_facts=4, limit_subjects=100000,
+        num_processes=8, num_threads=6, checkpoint_dir=f'./benchmark/final/fake_{fake_size}_build'
     )
+    # Labels and answers are fetched in batches here, saving makes no Wikidata requests of its own
+    fake_benchmark.resolve_entities()
     fake_benchmark.to_file(f'./benchmark/final/fake_{fake_size}.json')
 
 
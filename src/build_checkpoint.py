@@ -0,0 +1,101 @@
+import json
+import os
+from collections import defaultdict
+from pathlib import Path
+
+from relation import Relation
+
+
+class BuildCheckpoint:
+
+    MANIFEST_FILE = 'manifest.json'
+    EXAMPLES_FILE = 'examples.jsonl'
+    FAILURES_FILE = 'failures.jsonl'
+
+    def __init__(self, checkpoint_dir: str, save_every: int = 10):
+        self._dir = Path(checkpoint_dir)
+        self._save_every = save_every
+        self._manifest = None
+        self._unsaved = 0
+
+    def exists(self):
+        return (self._dir / self.MANIFEST_FILE).is_file()
+
+    @staticmethod
+    def _encode_args(args):
+        return [{'relation': arg.name} if isinstance(arg, Relation) else arg for arg in args]
+
+    @staticmethod
+    def _decode_args(args):
+        return tuple(Relation[arg['relation']] if isinstance(arg, dict) else arg for arg in args)
+
+    def start(self, build_function_name: str, tasks_args: list, seed: int):
+        self._dir.mkdir(parents=True, exist_ok=True)
+        self._manifest = {
+            'build_function': build_function_name,
+            'seed': seed,
+            'tasks': [self._encode_args(args) for args in tasks_args],
+            'completed': 0,
+            'built': 0,
+            'examples_bytes': 0,
+            'failures_bytes': 0,
+            'failures': dict(),
+        }
+        for file in [self.EXAMPLES_FILE, self.FAILURES_FILE]:
+            (self._dir / file).write_bytes(b'')
+        self.save()
+
+    def load(self):
+        with open(self._dir / self.MANIFEST_FILE, 'r', encoding='utf-8') as f:
+            self._manifest = json.load(f)
+        # Drop examples and failures written after the last saved manifest, their tasks will be rebuilt
+        for file, size in [(self.EXAMPLES_FILE, 'examples_bytes'), (self.FAILURES_FILE, 'failures_bytes')]:
+            with open(self._dir / file, 'r+b') as f:
+                f.truncate(self._manifest[size])
+        print(f'Resuming build from task {self.completed()}/{len(self._manifest["tasks"])} '
+              f'({self._manifest["built"]} examples built)')
+
+    def tasks(self):
+        return [self._decode_args(args) for args in self._manifest['tasks']]
+
+    def seed(self):
+        return self._manifest['seed']
+
+    def build_function_name(self):
+        return self._manifest['build_function']
+
+    def completed(self):
+        return self._manifest['completed']
+
+    def record(self, task_index: int, example_dict: dict, failures: dict):
+        if example_dict is not None:
+            with open(self._dir / self.EXAMPLES_FILE, 'ab') as f:
+                f.write((json.dumps(example_dict, ensure_ascii=False) + '\n').encode('utf-8'))
+                self._manifest['examples_bytes'] = f.tell()
+            self._manifest['built'] += 1
+        if failures:
+            with open(self._dir / self.FAILURES_FILE, 'ab') as f:
+                for axis, error in failures.items():
+                    line = json.dumps({'task': task_index, 'axis': axis, 'error': error}, ensure_ascii=False) + '\n'
+                    f.write(line.encode('utf-8'))
+                    self._manifest['failures'][axis] = self._manifest['failures'].get(axis, 0) + 1
+                self._manifest['failures_bytes'] = f.tell()
+        self._manifest['completed'] = task_index + 1
+        self._unsaved += 1
+        if self._unsaved >= self._save_every:
+            self.save()
+
+    def save(self):
+        tmp_path = self._dir / (self.MANIFEST_FILE + '.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self._manifest, f)
+        os.replace(tmp_path, self._dir / self.MANIFEST_FILE)
+        self._unsaved = 0
+
+    def failure_counts(self):
+        return defaultdict(int, self._manifest['failures'])
+
+    def example_dicts(self):
+        with open(self._dir / self.EXAMPLES_FILE, 'r', encoding='utf-8') as f:
+            for line in f:
+                yield json.loads(line)
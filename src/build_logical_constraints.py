@@ -30,6 +30,8 @@ class RelationalConstraints:
             subject_ids = [subject_ids]
         for subject_id in subject_ids:
             targets += subject_relation_to_targets(subject_id, relation)
+        # Queries keep a copy of their targets, so they are created once all the targets were collected
+        for subject_id in subject_ids:
             self.conditions.append(Query(subject_id, relation, targets))
         return targets
 
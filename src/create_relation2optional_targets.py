@@ -3,6 +3,8 @@ import os
 import random
 from collections import defaultdict
 from relation import Relation
+from wikidata.optional_targets import OptionalTargetsIndex, OPTIONAL_TARGETS_INDEX_PATH, OPTIONAL_TARGETS_JSON_PATH
+from wikidata.shard_index import FILTERED_RELATIONS_DIR
 
 
 checkable_relations = [relation.formal_name() for relation in Relation]
@@ -29,9 +31,9 @@ def get_relation2optional_targets(wikidata_dir: str):
 
 
 if __name__ == '__main__':
-    wikidata_dir = './wikidata/wikidata_full_kg/filtered_relations'
-    relation2optional_targets = get_relation2optional_targets(wikidata_dir)
-    with open('./wikidata/relation2optional_targets_new_limited.json', 'w+', encoding='utf-8') as f:
+    relation2optional_targets = get_relation2optional_targets(FILTERED_RELATIONS_DIR)
+    with open(OPTIONAL_TARGETS_JSON_PATH, 'w+', encoding='utf-8') as f:
         json.dump(relation2optional_targets, f)
+    OptionalTargetsIndex.build(relation2optional_targets, OPTIONAL_TARGETS_INDEX_PATH)
     print(relation2optional_targets.keys())
     print(len(relation2optional_targets))
\ No newline at end of file
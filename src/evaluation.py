@@ -1,3 +1,5 @@
+import argparse
+import os
 from collections import defaultdict
 
 from benchmark import Dataset, Example, TestsAxis
@@ -5,7 +7,7 @@ from modeleditor import ROMEModelEditor, InContextModelEditor, MENDModelEditor,
 from queryexecutor import GPT2QueryExecutor, GPT3QueryExecutor, GPTJQueryExecutor, GPTNeoXQueryExecutor, \
     LlamaQueryExecutor
 from testrunner import ExampleResult
-from testrunner import TestRunner, TestResult
+from testrunner import TestRunner, TestResult, SequentialTestRunner
 from wikidata.utils import write_json
 
 
@@ -15,23 +17,40 @@ class Evaluator:
         self._query_executor = query_executor
         self._model_editor = model_editor
         self._test_runner = TestRunner(query_executor, model_editor)
+        self._edits = 0
+        self._edit_seconds = 0.0
+
+    def edit_stats(self):
+        # Edit and restore time of the evaluated examples, a batch of examples is edited and restored once
+        return {
+            'edits': self._edits,
+            'seconds': self._edit_seconds,
+            'edits_per_second': self._edits / self._edit_seconds if self._edit_seconds else 0.0,
+        }
+
+    def _count_edits(self, edits: int, timings: dict):
+        self._edits += edits
+        self._edit_seconds += timings['edit'] + timings['restore']
 
     def average_acc(self, example: Example, test_cases: list, skip_edit: bool = False, skip_restore: bool = False):
         if not len(test_cases) and skip_edit:
             return 0.0, 0.0, 0.0, False
 
         run_res = self._test_runner.run_testcases(example, test_cases, skip_edit=skip_edit, skip_restore=skip_restore)
-        fact_edit_succeeded, res_dict = run_res
+        return self._accuracy(run_res, test_cases)
+
+    @staticmethod
+    def _accuracy(run_res, test_cases: list):
         edit_succeeded = True
-        if fact_edit_succeeded == ExampleResult.EDIT_FAILED:
+        if run_res.example_result == ExampleResult.EDIT_FAILED:
             edit_succeeded = False
 
         if not len(test_cases):
             return 0.0, 0.0, 0.0, edit_succeeded
 
-        werent_executed = len(res_dict[TestResult.NOT_EXECUTED])
-        successes = len(res_dict[TestResult.PASSED])
-        fails = len(res_dict[TestResult.FAILED])
+        werent_executed = run_res.count(TestResult.NOT_EXECUTED)
+        successes = run_res.count(TestResult.PASSED)
+        fails = run_res.count(TestResult.FAILED)
         executed = (successes + fails) / (successes + fails + werent_executed)
         return successes / (successes + fails) if successes else 0.0, executed, len(test_cases), edit_succeeded
 
@@ -53,16 +72,79 @@ class Evaluator:
     def evaluate_prev_storage_tests(self, example: Example):
         return self.average_acc(example, example.prev_storage_tests)
 
-    def evaluate(self, example: Example):
+    @staticmethod
+    def _axes_tests(example: Example):
+        return [
+            (TestsAxis.MAKING_UP, example.making_up_tests),
+            (TestsAxis.LOGICAL_CONSTRAINTS, example.logical_constraints),
+            (TestsAxis.SUBJECT_PARAPHRASING, example.subject_paraphrasing_tests),
+            (TestsAxis.TWO_HOP, example.two_hop_tests),
+            (TestsAxis.FORWARD_TWO_HOP, example.forward_two_hop_tests),
+            (TestsAxis.PREVIOUS_STORAGE, example.prev_storage_tests),
+        ]
+
+    @classmethod
+    def _axes_accuracy(cls, run_res, axes_tests: list):
         res = defaultdict()
-        res[TestsAxis.MAKING_UP] = self.evaluate_making_up_axis(example)
-        res[TestsAxis.LOGICAL_CONSTRAINTS] = self.evaluate_logical_constraints(example)
-        res[TestsAxis.SUBJECT_PARAPHRASING] = self.evaluate_subject_paraphrasing(example)
-        res[TestsAxis.TWO_HOP] = self.evaluate_two_hop_tests(example)
-        res[TestsAxis.FORWARD_TWO_HOP] = self.evaluate_forward_two_hop_tests(example)
-        res[TestsAxis.PREVIOUS_STORAGE] = self.evaluate_prev_storage_tests(example)
+        start = 0
+        for axis, test_cases in axes_tests:
+            res[axis] = cls._accuracy(run_res.slice(start, start + len(test_cases)), test_cases)
+            start += len(test_cases)
         return res
 
+    def evaluate(self, example: Example):
+        axes_tests = self._axes_tests(example)
+
+        # The tests of all the axes run together, so the example is edited and restored once
+        all_tests = [test_case for _, test_cases in axes_tests for test_case in test_cases]
+        run_res = self._test_runner.run_testcases(example, all_tests)
+        if self._model_editor is not None:
+            self._count_edits(1, run_res.timings)
+
+        return self._axes_accuracy(run_res, axes_tests)
+
+    def evaluate_batch(self, examples: list):
+        # The examples are edited together, so their accuracies include the interference between the edits
+        axes_tests_per_example = [self._axes_tests(example) for example in examples]
+        all_tests_per_example = [[test_case for _, test_cases in axes_tests for test_case in test_cases]
+                                 for axes_tests in axes_tests_per_example]
+        run_results = self._test_runner.run_testcases_batch(examples, all_tests_per_example)
+        if self._model_editor is not None:
+            self._count_edits(len(examples), run_results[0].timings)
+
+        return [self._axes_accuracy(run_res, axes_tests)
+                for run_res, axes_tests in zip(run_results, axes_tests_per_example)]
+
+    def evaluate_sequential(self, examples: list, reevaluate_every: int = 0, checkpoint_every: int = 0,
+                            checkpoint_path=None):
+        # The edits of the examples accumulate in the model, which is restored once they are all evaluated. Returns
+        # the accuracies of every edit, the accuracies of every re-evaluation of all the edits made so far, the
+        # latency of every edit, and the number of edits resumed from the checkpoint.
+        runner = SequentialTestRunner(self._query_executor, self._model_editor)
+        axes_tests_per_example = [self._axes_tests(example) for example in examples]
+        all_tests_per_example = [[test_case for _, test_cases in axes_tests for test_case in test_cases]
+                                 for axes_tests in axes_tests_per_example]
+        sequential_result = runner.run_sequential(examples, all_tests_per_example, reevaluate_every,
+                                                  checkpoint_every, checkpoint_path)
+        runner.restore_model()
+
+        results = [self._axes_accuracy(run_res, axes_tests) for run_res, axes_tests
+                   in zip(sequential_result.run_results, axes_tests_per_example)]
+        reevaluations = [(edits, [self._axes_accuracy(run_res, axes_tests)
+                                  for run_res, axes_tests in zip(run_results, axes_tests_per_example)])
+                         for edits, run_results in sequential_result.reevaluations]
+        return results, reevaluations, sequential_result.edit_latencies, sequential_result.first_edit
+
+    @staticmethod
+    def average_precisions(evaluation_results: list):
+        # The average precision per axis over the examples whose edit succeeded and whose tests were executed
+        precisions = defaultdict(list)
+        for results in evaluation_results:
+            for axis, (precision, executed, size, edit_succeeded) in results.items():
+                if executed != 0.0 and edit_succeeded:
+                    precisions[axis.name].append(precision)
+        return {axis: sum(values) / len(values) for axis, values in precisions.items()}
+
 
 class ConditionsEvaluator(Evaluator):
 
@@ -97,8 +179,51 @@ if __name__ == '__main__':
         top_views_path
     ]
 
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--memit-batch-size', type=int, default=16,
+                        help='The number of examples MEMIT also edits together, 1 to only edit them one by one')
+    parser.add_argument('--sequential', action='store_true',
+                        help='Accumulate the edits of the examples in the model instead of restoring after each one')
+    parser.add_argument('--reevaluate-every', type=int, default=50,
+                        help='In sequential mode, re-evaluate all the edits made so far every this many edits')
+    parser.add_argument('--checkpoint-every', type=int, default=50,
+                        help='In sequential mode, checkpoint the accumulated weight deltas every this many edits')
+    parser.add_argument('--checkpoint-dir', default=None,
+                        help='In sequential mode, the directory of the checkpoints, which are resumed when they exist')
+    args = parser.parse_args()
+
+    # MEMIT is also evaluated with batches of examples edited together, the accuracies of batch size 1 are kept to
+    # report the interference of the batched edits
+    memit_batch_sizes = sorted({1, args.memit_batch_size})
+    single_edit_precision = dict()
+
     for model in models:
         for editor in editors:
+            # Every editor gets a freshly loaded model, since editors such as MEND change the model and tokenizer for
+            # good. The model is shared by the datasets and batch sizes of the editor, which restores it after edits.
+            davinvci_query_executor = GPT3QueryExecutor(model_size='text-davinci-003')
+            if model == 'gpt2-medium':
+                query_executor = GPT2QueryExecutor('medium')
+            if model == 'gpt2-large':
+                query_executor = GPT2QueryExecutor('large')
+            if model == 'gpt2-xl':
+                query_executor = GPT2QueryExecutor('xl')
+            if model == 'gpt-j':
+                query_executor = GPTJQueryExecutor()
+            if model == 'gpt-neo':
+                query_executor = GPTNeoXQueryExecutor()
+            if model == 'llama':
+                query_executor = LlamaQueryExecutor()
+
+            if editor == 'mend':
+                model_editor = MENDModelEditor(query_executor)
+            if editor == 'rome':
+                model_editor = ROMEModelEditor(query_executor)
+            if editor == 'memit':
+                model_editor = MEMITModelEditor(query_executor)
+            if editor == 'in-context':
+                model_editor = InContextModelEditor(query_executor)
+
             for dataset_path in datasets:
 
                 if dataset_path == recently_modified_path:
@@ -108,102 +233,144 @@ if __name__ == '__main__':
                 if dataset_path == top_views_path:
                     dataset_name = 'top_views'
 
-                experiment_name = f'{model}_{editor}_{dataset_name}'
-                print(experiment_name)
-
-                davinvci_query_executor = GPT3QueryExecutor(model_size='text-davinci-003')
-                if model == 'gpt2-medium':
-                    query_executor = GPT2QueryExecutor('medium')
-                if model == 'gpt2-large':
-                    query_executor = GPT2QueryExecutor('large')
-                if model == 'gpt2-xl':
-                    query_executor = GPT2QueryExecutor('xl')
-                if model == 'gpt-j':
-                    query_executor = GPTJQueryExecutor()
-                if model == 'gpt-neo':
-                    query_executor = GPTNeoXQueryExecutor()
-                if model == 'llama':
-                    query_executor = LlamaQueryExecutor()
-
-                if editor == 'mend':
-                    model_editor = MENDModelEditor(query_executor)
-                if editor == 'rome':
-                    model_editor = ROMEModelEditor(query_executor)
-                if editor == 'memit':
-                    model_editor = MEMITModelEditor(query_executor)
-                if editor == 'in-context':
-                    model_editor = InContextModelEditor(query_executor)
-
-                evaluator = Evaluator(query_executor=query_executor, model_editor=model_editor)
-                dataset = Dataset.from_file(dataset_path)
-
-                precisions_json = dict()
+                # The same examples are evaluated with every batch size
+                dataset = Dataset.open(dataset_path)
                 num_of_examples = 200
-
-                examples_for_eval = dataset.sample(num_of_examples)
+                if args.sequential:
+                    # A resumed stream must see the examples in the same order, so it is not sampled
+                    examples_for_eval = [dataset[i] for i in range(min(num_of_examples, len(dataset)))]
+                else:
+                    examples_for_eval = dataset.sample(num_of_examples)
                 eval_size = len(examples_for_eval)
 
-                succeeded_edits = defaultdict(lambda: 0)
-                average_precision = defaultdict(lambda: 0)
-                average_executed = defaultdict(lambda: 0)
-                average_size = defaultdict(lambda: 0)
-                total_checked_examples = defaultdict(lambda: 0)
-                executed_portion_dict = defaultdict(lambda: 0)
-
-                for i, example in enumerate(examples_for_eval):
-                    if (i + 1) % 10 == 0:
-                        print(f'{i + 1}/{eval_size}')
-
+                valid_examples = []
+                for example in examples_for_eval:
                     if example.fact.get_subject_label() == '' or example.fact.get_target_label() == '':
                         print(f'Skipping example: {example.to_dict()}')
                         continue
+                    valid_examples.append(example)
 
-                    evaluation_results = evaluator.evaluate(example)
-
-                    res_dict_for_json = dict()
-                    for axis, results in evaluation_results.items():
-                        precision, executed, size, edit_succeeded = results
-                        if executed == 0.0:
-                            continue
-                        if edit_succeeded:
-                            succeeded_edits[axis] += 1
-                            average_precision[axis] += precision
-                            res_dict_for_json[axis.name] = precision
-                            average_executed[axis] += executed
-                            average_size[axis] += size
-                            # precisions_json[str(example.fact)] = precision
-                        total_checked_examples[axis] += 1
-
-                    precisions_json[str(example.fact)] = res_dict_for_json
-
-                    for axis in TestsAxis:
-                        if axis in evaluation_results:
-                            executed_portion_dict[axis] += evaluation_results[axis][1]
-
-                res_str = ''
-                for axis in TestsAxis:
-                    print(f'Results of axis {axis}:')
-                    res_str += f'Results of axis {axis}:\n'
-
-                    if total_checked_examples[axis] == 0:
-                        print(f'No checked tests for this axis')
-                        res_str += f'No checked tests for this axis\n'
+                if args.sequential:
+                    experiment_name = f'{model}_{editor}_{dataset_name}_sequential'
+                    print(experiment_name)
+                    if not model_editor.CHANGES_WEIGHTS:
+                        print(f'Skipping {editor}, sequential editing requires an editor that changes the weights')
                         continue
 
-                    average_precision[axis] /= succeeded_edits[axis]
-                    average_executed[axis] /= succeeded_edits[axis]
-                    average_size[axis] /= succeeded_edits[axis]
-
-                    print(f'{(succeeded_edits[axis] / eval_size) * 100} successful edits (out of {eval_size})')
-                    res_str += f'{(succeeded_edits[axis] / eval_size) * 100} successful edits (out of {eval_size})\n'
-                    print(f'Average accuracy is {average_precision[axis]}')
-                    res_str += f'Average accuracy is {average_precision[axis]}\n'
-                    print(f'Average portion of executed_tests is {average_executed[axis]}')
-                    res_str += f'Average portion of executed_tests is {average_executed[axis]}\n'
-                    print(f'Average total number of tests is {average_size[axis]}')
-                    res_str += f'Average total number of tests is {average_size[axis]}\n'
+                    checkpoint_path = None
+                    if args.checkpoint_dir is not None:
+                        os.makedirs(args.checkpoint_dir, exist_ok=True)
+                        checkpoint_path = os.path.join(args.checkpoint_dir, f'{experiment_name}.pt')
+
+                    evaluator = Evaluator(query_executor=query_executor, model_editor=model_editor)
+                    results, reevaluations, edit_latencies, resumed_edits = evaluator.evaluate_sequential(
+                        valid_examples, args.reevaluate_every, args.checkpoint_every, checkpoint_path)
+
+                    reevaluations_json = []
+                    for edits, reevaluation_results in reevaluations:
+                        precisions = Evaluator.average_precisions(reevaluation_results)
+                        print(f'Average accuracy after {edits} edits: {precisions}')
+                        reevaluations_json.append({'edits': edits, 'accuracy': precisions})
+                    write_json({
+                        'accuracy': Evaluator.average_precisions(results),
+                        'reevaluations': reevaluations_json,
+                        'edit_latencies': edit_latencies,
+                        'resumed_edits': resumed_edits,
+                    }, f'./{experiment_name}_res.json')
+                    continue
+
+                batch_sizes = memit_batch_sizes if editor == 'memit' else [1]
+                for batch_size in batch_sizes:
+                    experiment_name = f'{model}_{editor}_{dataset_name}'
+                    if batch_size > 1:
+                        experiment_name += f'_batch_{batch_size}'
+                    print(experiment_name)
+
+                    evaluator = Evaluator(query_executor=query_executor, model_editor=model_editor)
+
+                    precisions_json = dict()
+
+                    succeeded_edits = defaultdict(lambda: 0)
+                    average_precision = defaultdict(lambda: 0)
+                    average_executed = defaultdict(lambda: 0)
+                    average_size = defaultdict(lambda: 0)
+                    total_checked_examples = defaultdict(lambda: 0)
+                    executed_portion_dict = defaultdict(lambda: 0)
+
+                    examples_results = []
+                    for i in range(0, len(valid_examples), batch_size):
+                        if batch_size > 1 or (i + 1) % 10 == 0:
+                            print(f'{i + 1}/{len(valid_examples)}')
+                        batch = valid_examples[i:i + batch_size]
+                        if batch_size == 1:
+                            examples_results.append((batch[0], evaluator.evaluate(batch[0])))
+                        else:
+                            examples_results.extend(zip(batch, evaluator.evaluate_batch(batch)))
+
+                    for example, evaluation_results in examples_results:
+                        res_dict_for_json = dict()
+                        for axis, results in evaluation_results.items():
+                            precision, executed, size, edit_succeeded = results
+                            if executed == 0.0:
+                                continue
+                            if edit_succeeded:
+                                succeeded_edits[axis] += 1
+                                average_precision[axis] += precision
+                                res_dict_for_json[axis.name] = precision
+                                average_executed[axis] += executed
+                                average_size[axis] += size
+                                # precisions_json[str(example.fact)] = precision
+                            total_checked_examples[axis] += 1
+
+                        precisions_json[str(example.fact)] = res_dict_for_json
+
+                        for axis in TestsAxis:
+                            if axis in evaluation_results:
+                                executed_portion_dict[axis] += evaluation_results[axis][1]
+
+                    res_str = ''
+                    for axis in TestsAxis:
+                        print(f'Results of axis {axis}:')
+                        res_str += f'Results of axis {axis}:\n'
 
-                write_json(precisions_json, f'./{experiment_name}_res_2.json')
+                        if total_checked_examples[axis] == 0:
+                            print(f'No checked tests for this axis')
+                            res_str += f'No checked tests for this axis\n'
+                            continue
 
-                with open(f'./{experiment_name}_2.txt', 'w+', encoding='utf-8') as f:
-                    f.write(res_str)
+                        average_precision[axis] /= succeeded_edits[axis]
+                        average_executed[axis] /= succeeded_edits[axis]
+                        average_size[axis] /= succeeded_edits[axis]
+
+                        print(f'{(succeeded_edits[axis] / eval_size) * 100} successful edits (out of {eval_size})')
+                        res_str += f'{(succeeded_edits[axis] / eval_size) * 100} successful edits (out of {eval_size})\n'
+                        print(f'Average accuracy is {average_precision[axis]}')
+                        res_str += f'Average accuracy is {average_precision[axis]}\n'
+                        print(f'Average portion of executed_tests is {average_executed[axis]}')
+                        res_str += f'Average portion of executed_tests is {average_executed[axis]}\n'
+                        print(f'Average total number of tests is {average_size[axis]}')
+                        res_str += f'Average total number of tests is {average_size[axis]}\n'
+
+                        # Interference of the batched edits, as the change from the accuracy of single edits
+                        single_edit_key = (model, editor, dataset_name, axis)
+                        if batch_size == 1:
+                            single_edit_precision[single_edit_key] = average_precision[axis]
+                        elif single_edit_key in single_edit_precision:
+                            interference = average_precision[axis] - single_edit_precision[single_edit_key]
+                            print(f'Accuracy change from single edits is {interference}')
+                            res_str += f'Accuracy change from single edits is {interference}\n'
+
+                    edit_stats = evaluator.edit_stats()
+                    print(f'Edit throughput: {edit_stats["edits_per_second"]:.3f} edits/sec '
+                          f'({edit_stats["edits"]} edits, batch size {batch_size})')
+                    res_str += f'Edit throughput is {edit_stats["edits_per_second"]} edits/sec\n'
+
+                    cache_stats = query_executor.cache_stats()
+                    print(f'Generation cache: {cache_stats["hits"]} hits, {cache_stats["misses"]} misses '
+                          f'({cache_stats["hit_rate"] * 100:.1f}% hit rate)')
+                    res_str += f'Generation cache hit rate is {cache_stats["hit_rate"]}\n'
+
+                    write_json(precisions_json, f'./{experiment_name}_res_2.json')
+
+                    with open(f'./{experiment_name}_2.txt', 'w+', encoding='utf-8') as f:
+                        f.write(res_str)
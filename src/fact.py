@@ -1,20 +1,34 @@
+from record import Record, intern_id
 from relation import Relation
 from wikidata.utils import get_label
 from query import Query
 
 
-class Fact:
+class Fact(Record):
 
-    def __init__(self, subject_id, relation, target_id):
-        self._subject_id = subject_id
-        self._relation = relation
-        self._target_id = target_id
+    __slots__ = ('_subject_id', '_relation', '_target_id', '_subject_label', '_target_label', '_prompt')
+
+    def __init__(self, subject_id, relation, target_id, prompt=None):
+        self._set('_subject_id', intern_id(subject_id))
+        self._set('_relation', relation)
+        self._set('_target_id', intern_id(target_id))
+        # Labels are looked up once on first use, the phrased fact is taken as is when loaded from a dict
+        self._set('_subject_label', None)
+        self._set('_target_label', None)
+        self._set('_prompt', prompt)
+
+    def _key(self):
+        return self._subject_id, self._relation, self._target_id
 
     def get_subject_label(self):
-        return get_label(self._subject_id)
+        if self._subject_label is None:
+            self._set('_subject_label', get_label(self._subject_id))
+        return self._subject_label
 
     def get_target_label(self):
-        return get_label(self._target_id)
+        if self._target_label is None:
+            self._set('_target_label', get_label(self._target_id))
+        return self._target_label
 
     def get_relation_label(self):
         return self._relation.name.replace('_', ' ')
@@ -23,10 +37,23 @@ class Fact:
         return Query(self._subject_id, self._relation, self._target_id)
 
     def get_fact_prompt(self):
-        return self._relation.phrase(get_label(self._subject_id))
+        return self._relation.phrase(self.get_subject_label())
 
     def get_fact_phrased(self):
-        return self._relation.phrase(get_label(self._subject_id)) + f' {get_label(self._target_id)}.'
+        if self._prompt is None:
+            self._set('_prompt', self.get_fact_prompt() + f' {self.get_target_label()}.')
+        return self._prompt
+
+    def resolve(self):
+        # Only the phrased fact is serialized, so the labels are looked up only when it was not loaded
+        self.get_fact_phrased()
+        return self
+
+    def entity_ids(self):
+        return [self._subject_id, self._target_id]
+
+    def unresolved_entity_ids(self):
+        return self.entity_ids() if self._prompt is None else []
 
     def to_dict(self):
         return {
@@ -38,7 +65,7 @@ class Fact:
 
     @staticmethod
     def from_dict(d):
-        return Fact(d['subject_id'], Relation[d['relation']], d['target_id'])
+        return Fact(d['subject_id'], Relation[d['relation']], d['target_id'], d.get('prompt'))
 
     def __str__(self):
         return f'({self.get_subject_label()}, {self.get_relation_label()}, {self.get_target_label()})'
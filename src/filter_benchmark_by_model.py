@@ -1,9 +1,10 @@
 import argparse
+from contextlib import nullcontext
 
-from benchmark import Dataset, RecentlyAddedExample, CounterFactualExample
+from benchmark import Dataset, JsonlDatasetWriter, RecentlyAddedExample, CounterFactualExample
 from queryexecutor import GPT2QueryExecutor, GPTJQueryExecutor, GPTNeoXQueryExecutor, LlamaQueryExecutor, \
     GPT3QueryExecutor
-from testrunner import TestRunner, ExampleResult, TestResult
+from testrunner import TestRunner, ExampleResult
 
 
 def get_query_executor(model_name):
@@ -24,70 +25,89 @@ def get_query_executor(model_name):
 
 
 def filter_tests(test_runner, example, testcases, include_all_facts):
-    example_result, test_results = test_runner.run_testcases(example, testcases)
-    if not include_all_facts and example_result != ExampleResult.EXECUTED:
+    run_result = test_runner.run_testcases(example, testcases)
+    if not include_all_facts and run_result.example_result != ExampleResult.EXECUTED:
         return None
-    return [test for test in testcases if test not in test_results[TestResult.NOT_EXECUTED]]
+    return run_result.executed_test_cases()
 
 
 def main(args):
     print('Loading dataset')
-    dataset = Dataset.from_file(args.benchmark)
+    dataset = Dataset.open(args.benchmark)
     print('Loading model')
     query_executor = get_query_executor(args.model)
+    if args.scoring != 'generate':
+        query_executor.set_scoring(args.scoring, args.decision_rule, args.threshold)
     test_runner = TestRunner(query_executor, None)
+    # JSON Lines output is streamed, so that filtering runs in constant memory. The writer is closed even if
+    # filtering fails, which keeps the examples written so far readable with their offset index.
+    writer_context = JsonlDatasetWriter(args.output) if args.output.endswith('.jsonl') else nullcontext()
     filtered_examples = []
+    filtered_examples_count = 0
     test_count = 0
     filtered_test_count = 0
 
-    for i, example in enumerate(dataset.examples):
-        print(f'Example {i + 1} / {len(dataset.examples)}: {example.fact.to_dict()}')
+    with writer_context as writer:
+        for i, example in enumerate(dataset):
+            print(f'Example {i + 1} / {len(dataset)}: {example.fact.to_dict()}')
 
-        test_count += len(example.making_up_tests) + len(example.logical_constraints) + \
-                      len(example.subject_paraphrasing_tests) + len(example.two_hop_tests) + \
-                      len(example.prev_storage_tests)
-        prev_filtered_test_count = filtered_test_count
+            test_count += len(example.making_up_tests) + len(example.logical_constraints) + \
+                          len(example.subject_paraphrasing_tests) + len(example.two_hop_tests) + \
+                          len(example.prev_storage_tests)
+            prev_filtered_test_count = filtered_test_count
 
-        filtered_making_up_tests = filter_tests(test_runner, example, example.making_up_tests, args.include_all_facts)
-        filtered_test_count += len(filtered_making_up_tests)
-
-        if filtered_making_up_tests is None:  # Example shouldn't be included at all
-            continue
-
-        filtered_logical_constraints = filter_tests(test_runner, example, example.logical_constraints,
+            filtered_making_up_tests = filter_tests(test_runner, example, example.making_up_tests,
                                                     args.include_all_facts)
-        filtered_test_count += len(filtered_logical_constraints)
-
-        filtered_subject_paraphrasing_tests = filter_tests(test_runner, example, example.subject_paraphrasing_tests,
-                                                           args.include_all_facts)
-        filtered_test_count += len(filtered_subject_paraphrasing_tests)
-
-        filtered_two_hop_tests = filter_tests(test_runner, example, example.two_hop_tests, args.include_all_facts)
-        filtered_test_count += len(filtered_two_hop_tests)
-
-        filtered_prev_storage_tests = filter_tests(test_runner, example, example.prev_storage_tests,
-                                                   args.include_all_facts)
-        filtered_test_count += len(filtered_prev_storage_tests)
-
-        if prev_filtered_test_count == filtered_test_count:  # Example has no tests that passed the filter
-            continue
-
-        if isinstance(example, RecentlyAddedExample):
-            filtered_examples.append(RecentlyAddedExample(example.fact, filtered_making_up_tests,
-                                                          filtered_logical_constraints,
-                                                          filtered_subject_paraphrasing_tests,
-                                                          filtered_two_hop_tests, filtered_prev_storage_tests))
-        elif isinstance(example, CounterFactualExample):
-            filtered_examples.append(CounterFactualExample(example.fact, example.previous_fact,
-                                                           filtered_making_up_tests, filtered_logical_constraints,
-                                                           filtered_subject_paraphrasing_tests, filtered_two_hop_tests,
-                                                           filtered_prev_storage_tests))
-
-    print(f'Filtered dataset has {len(filtered_examples)} / {len(dataset.examples)} examples')
+            if filtered_making_up_tests is None:  # Example shouldn't be included at all
+                continue
+            filtered_test_count += len(filtered_making_up_tests)
+
+            filtered_logical_constraints = filter_tests(test_runner, example, example.logical_constraints,
+                                                        args.include_all_facts)
+            filtered_test_count += len(filtered_logical_constraints)
+
+            filtered_subject_paraphrasing_tests = filter_tests(test_runner, example, example.subject_paraphrasing_tests,
+                                                               args.include_all_facts)
+            filtered_test_count += len(filtered_subject_paraphrasing_tests)
+
+            filtered_two_hop_tests = filter_tests(test_runner, example, example.two_hop_tests, args.include_all_facts)
+            filtered_test_count += len(filtered_two_hop_tests)
+
+            filtered_prev_storage_tests = filter_tests(test_runner, example, example.prev_storage_tests,
+                                                       args.include_all_facts)
+            filtered_test_count += len(filtered_prev_storage_tests)
+
+            if prev_filtered_test_count == filtered_test_count:  # Example has no tests that passed the filter
+                continue
+
+            if isinstance(example, RecentlyAddedExample):
+                filtered_example = RecentlyAddedExample(example.fact, filtered_making_up_tests,
+                                                        filtered_logical_constraints,
+                                                        filtered_subject_paraphrasing_tests,
+                                                        filtered_two_hop_tests, filtered_prev_storage_tests)
+            elif isinstance(example, CounterFactualExample):
+                filtered_example = CounterFactualExample(example.fact, example.previous_fact,
+                                                         filtered_making_up_tests, filtered_logical_constraints,
+                                                         filtered_subject_paraphrasing_tests, filtered_two_hop_tests,
+                                                         filtered_prev_storage_tests)
+            else:
+                continue
+
+            filtered_examples_count += 1
+            if writer is not None:
+                writer.write(filtered_example)
+            else:
+                filtered_examples.append(filtered_example)
+
+    print(f'Filtered dataset has {filtered_examples_count} / {len(dataset)} examples')
     print(f'Filtered dataset has {filtered_test_count} / {test_count} tests')
-    print('Saving filtered dataset')
-    filtered_dataset = Dataset(filtered_examples)
-    filtered_dataset.to_file(args.output)
+    cache_stats = query_executor.cache_stats()
+    print(f'Generation cache: {cache_stats["hits"]} hits, {cache_stats["misses"]} misses '
+          f'({cache_stats["hit_rate"] * 100:.1f}% hit rate)')
+    if writer is None:
+        print('Saving filtered dataset')
+        filtered_dataset = Dataset(filtered_examples)
+        filtered_dataset.to_file(args.output)
 
     print('Done')
 
@@ -100,7 +120,16 @@ if __name__ == '__main__':
                                                                  'llama-7b', 'llama-13b',
                                                                  'gpt-3'])
     parser.add_argument('output', help='The output filtered benchmark file path')
+    parser.add_argument('--scoring', choices=['generate', 'logits'], default='generate',
+                        help='Whether queries are verified by generating an answer or by scoring the answers logits')
+    parser.add_argument('--decision-rule', choices=['greedy', 'threshold'], default='greedy',
+                        help='How an answer is accepted with logits scoring')
+    parser.add_argument('--threshold', type=float, default=-1.0,
+                        help='The minimal mean answer token log-probability for the threshold decision rule')
     parser.add_argument('--include-all-facts', action=argparse.BooleanOptionalAction, default=True,
                         help='Whether to include all facts or only facts that pass the known/unknown test')
 
-    main(parser.parse_args())
+    args = parser.parse_args()
+    if args.model == 'gpt-3' and args.scoring == 'logits':
+        parser.error('logits scoring is not supported for gpt-3, whose answers can only be generated')
+    main(args)
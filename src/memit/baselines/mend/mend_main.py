@@ -29,7 +29,7 @@ class MendRewriteExecutor:
         model_filename = (
             f"mend-{mini_string}{params.n_toks}tok-{train_ds}{model_name}.pt"
         )
-        model_dir = "baselines/mend/weights"
+        model_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "weights")
 
         os.makedirs(model_dir, exist_ok=True)
         if not os.path.isfile(f"{model_dir}/{model_filename}"):
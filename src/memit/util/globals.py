@@ -2,11 +2,14 @@ from pathlib import Path
 
 import yaml
 
-with open("globals.yml", "r") as stream:
+# Relative paths are resolved against the repository root rather than the working directory
+ROOT_DIR = Path(__file__).resolve().parent.parent
+
+with open(ROOT_DIR / "globals.yml", "r") as stream:
     data = yaml.safe_load(stream)
 
 (RESULTS_DIR, DATA_DIR, STATS_DIR, HPARAMS_DIR, KV_DIR) = (
-    Path(z)
+    ROOT_DIR / z
     for z in [
         data["RESULTS_DIR"],
         data["DATA_DIR"],
@@ -5,6 +5,17 @@ import torch
 from queryexecutor import QueryExecutor
 
 
+# The memit repository is imported from its own directory, where its packages (memit, rome, util, baselines) are top
+# level. Its paths are resolved relative to that directory, so the working directory is never changed while editing.
+MEMIT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'memit')
+HPARAMS_DIR = os.path.join(MEMIT_DIR, 'hparams')
+
+
+def _add_memit_to_path():
+    if MEMIT_DIR not in sys.path:
+        sys.path.append(MEMIT_DIR)
+
+
 class ModelEditor:
 
     def __init__(self, query_executor):
@@ -14,33 +25,141 @@ class ModelEditor:
         self._model_name = self._query_executor.get_model_name()
         self._model_device = self._query_executor.get_device()
 
+    # Editors that change the model weights move the query executor to a new model state, so cached generations
+    # of the unedited model are not used while the edit is applied
+    CHANGES_WEIGHTS = True
+    # Whether the last restore brought back the exact weights from before the edit
+    _restored_exactly = True
+
     def edit_model(self, fact):
-        raise NotImplementedError()  # Override in concrete classes
+        self._edit_model(fact)
+        if self.CHANGES_WEIGHTS:
+            self._query_executor.push_model_state()
+
+    def edit_model_batch(self, facts):
+        # Inserts all the facts with a single edit, which restore_model removes together
+        self._edit_model_batch(facts)
+        if self.CHANGES_WEIGHTS:
+            self._query_executor.push_model_state()
 
     def restore_model(self):
+        self._restore_model()
+        if self.CHANGES_WEIGHTS:
+            self._query_executor.pop_model_state()
+            if not self._restored_exactly:
+                # The weights only approximate the ones before the edit, so the generations cached for those are
+                # not reused
+                self._query_executor.push_model_state()
+
+    def _edit_model(self, fact):
+        raise NotImplementedError()  # Override in concrete classes
+
+    def _edit_model_batch(self, facts):
+        raise NotImplementedError()  # Override in concrete classes supporting batch edits
+
+    def _restore_model(self):
         raise NotImplementedError()  # Override in concrete classes
 
 
 class InContextModelEditor(ModelEditor):
 
+    # The context is part of the generation cache key
+    CHANGES_WEIGHTS = False
+
     def __init__(self, query_executor: QueryExecutor):
         super().__init__(query_executor)
 
-    def edit_model(self, fact):
+    def _edit_model(self, fact):
         context = 'Imagine that ' + fact.get_fact_phrased() + '\n'
         print(f'In Context Editing added context: {context}')
         self._query_executor.set_prompt_context(context)
 
-    def restore_model(self):
+    def _restore_model(self):
         self._query_executor.set_prompt_context('')
 
 
 class RomeStyleModelEditor(ModelEditor):
 
-    def __init__(self, query_executor):
+    def __init__(self, query_executor, delta_restore=False, drift_check_every=0, drift_tolerance=1e-5):
         self._changed_weights = None
+        # With delta_restore only the low-rank factors of an edit are kept, and restoring subtracts their product in
+        # place. Every drift_check_every edits the full weights are copied as well, to measure the difference left by
+        # the subtraction and to reset it. Restores that only subtract move the query executor to a new model state.
+        self._delta_restore = delta_restore
+        self._deltas = None
+        self._drift_check_every = drift_check_every
+        self._drift_tolerance = drift_tolerance
+        self._edits_count = 0
+        self._max_drift = 0.0
         super().__init__(query_executor)
 
+        _add_memit_to_path()
+        from util import nethook
+        from rome.rome_main import upd_matrix_match_shape
+        self._nethook = nethook
+        self._upd_matrix_match_shape = upd_matrix_match_shape
+
+    def _hparams_path(self, algorithm):
+        return os.path.join(HPARAMS_DIR, algorithm, f'{self._model_name}.json')
+
+    def get_max_drift(self):
+        return self._max_drift
+
+    def _weight_update(self, factors, weight):
+        raise NotImplementedError()  # Override in concrete classes supporting delta restore
+
+    def _apply_deltas(self, deltas):
+        nethook = self._nethook
+        check_drift = self._drift_check_every and self._edits_count % self._drift_check_every == 0
+        self._changed_weights = dict() if check_drift else None
+        with torch.no_grad():
+            for w_name, factors in deltas.items():
+                w = nethook.get_parameter(self._model, w_name)
+                if check_drift:
+                    self._changed_weights[w_name] = w.detach().clone()
+                w[...] += self._upd_matrix_match_shape(self._weight_update(factors, w), w.shape)
+        self._deltas = list(deltas.items())
+        self._edits_count += 1
+        print(f'New weights successfully inserted into {list(deltas.keys())}')
+
+    def _restore_deltas(self):
+        nethook = self._nethook
+        with torch.no_grad():
+            for w_name, factors in reversed(self._deltas):
+                w = nethook.get_parameter(self._model, w_name)
+                w[...] -= self._upd_matrix_match_shape(self._weight_update(factors, w), w.shape)
+            if self._changed_weights is not None:
+                drift = max((nethook.get_parameter(self._model, k) - v.to(self._model_device)).abs().max().item()
+                            for k, v in self._changed_weights.items())
+                self._max_drift = max(self._max_drift, drift)
+                print(f'Delta restore drift: {drift}')
+                if drift > self._drift_tolerance:
+                    print(f'Delta restore drift is above the tolerance of {self._drift_tolerance}')
+                for k, v in self._changed_weights.items():
+                    nethook.get_parameter(self._model, k)[...] = v.to(self._model_device)
+        self._restored_exactly = self._changed_weights is not None
+        self._deltas = None
+        self._changed_weights = None
+
+    def get_pre_edit_weights(self):
+        # The weights changed by the last edit as they were before it, and whether they are exact rather than
+        # recomputed from the delta factors
+        if self._changed_weights is not None:
+            return dict(self._changed_weights), True
+        if self._deltas is None:
+            return dict(), True
+        weights = dict()
+        with torch.no_grad():
+            for w_name, factors in self._deltas:
+                w = self._nethook.get_parameter(self._model, w_name)
+                weights[w_name] = w - self._upd_matrix_match_shape(self._weight_update(factors, w), w.shape)
+        return weights, False
+
+    def keep_edit(self):
+        # Leaves the last edit in the model, restore_model then only returns the query executor to its model state
+        self._changed_weights = None
+        self._deltas = None
+
     @staticmethod
     def _format_fact_for_rome(fact):
         subject = fact.get_subject_label()
@@ -48,74 +167,80 @@ class RomeStyleModelEditor(ModelEditor):
         prompt = fact.get_fact_prompt().replace(subject, '{}')
         return [{'prompt': prompt, 'subject': subject, 'target_new': {'str': target}}]
 
-    def edit_model(self, fact):
+    def _edit_model(self, fact):
         raise NotImplementedError()  # Override in concrete classes
 
-    def restore_model(self):
-        if self._changed_weights is None:
+    def _restore_model(self):
+        self._restored_exactly = True
+        if self._changed_weights is None and self._deltas is None:
             return
 
-        os.chdir('./memit')
-        sys.path.append('..')
-        from util import nethook
-
-        with torch.no_grad():
-            for k, v in self._changed_weights.items():
-                nethook.get_parameter(self._model, k)[...] = v.to(self._model_device)
-
-        sys.path.remove('..')
-        os.chdir('../..')
+        if self._deltas is not None:
+            self._restore_deltas()
+        else:
+            with torch.no_grad():
+                for k, v in self._changed_weights.items():
+                    self._nethook.get_parameter(self._model, k)[...] = v.to(self._model_device)
 
 
 class MEMITModelEditor(RomeStyleModelEditor):
 
-    def __init__(self, query_executor):
-        super().__init__(query_executor)
-
-    def edit_model(self, fact):
-        os.chdir('./memit')
-        sys.path.append('..')
+    def __init__(self, query_executor, delta_restore=False, drift_check_every=0, drift_tolerance=1e-5):
+        super().__init__(query_executor, delta_restore, drift_check_every, drift_tolerance)
         from memit import MEMITHyperParams, apply_memit_to_model
+        from memit.memit_main import execute_memit
+        self._apply_memit_to_model = apply_memit_to_model
+        self._execute_memit = execute_memit
+        self._hparams = MEMITHyperParams.from_json(self._hparams_path('MEMIT'))
 
-        requests = self._format_fact_for_rome(fact)
-        hparams = MEMITHyperParams.from_json(f'hparams/MEMIT/{self._model_name}.json')
-        _, self._changed_weights = apply_memit_to_model(self._model, self._tokenizer, requests, hparams, return_orig_weights=True)
+    def _weight_update(self, factors, weight):
+        # The same update apply_memit_to_model adds, from the (adj_k, resid) factors returned by execute_memit
+        key_mat, val_mat = factors
+        return (key_mat.to(weight.device) @ val_mat.to(weight.device).T).float()
 
-        sys.path.remove('..')
-        os.chdir('../..')
+    def _edit_model(self, fact):
+        self._edit_model_batch([fact])
+
+    def _edit_model_batch(self, facts):
+        # MEMIT inserts all the requests in one solve
+        requests = [request for fact in facts for request in self._format_fact_for_rome(fact)]
+        if self._delta_restore:
+            self._apply_deltas(self._execute_memit(self._model, self._tokenizer, requests, self._hparams))
+        else:
+            _, self._changed_weights = self._apply_memit_to_model(self._model, self._tokenizer, requests, self._hparams, return_orig_weights=True)
 
 
 class ROMEModelEditor(RomeStyleModelEditor):
 
-    def __init__(self, query_executor):
-        super().__init__(query_executor)
+    def __init__(self, query_executor, delta_restore=False, drift_check_every=0, drift_tolerance=1e-5):
+        super().__init__(query_executor, delta_restore, drift_check_every, drift_tolerance)
+        from rome import ROMEHyperParams, apply_rome_to_model, execute_rome
+        self._apply_rome_to_model = apply_rome_to_model
+        self._execute_rome = execute_rome
+        self._hparams = ROMEHyperParams.from_json(self._hparams_path('ROME'))
 
-    def edit_model(self, fact):
-        os.chdir('./memit')
-        sys.path.append('..')
-        from rome import ROMEHyperParams, apply_rome_to_model
+    def _weight_update(self, factors, weight):
+        # The rank-1 update apply_rome_to_model adds, from the (left, right) vectors returned by execute_rome
+        left_vector, right_vector = factors
+        return (left_vector.unsqueeze(1) @ right_vector.unsqueeze(0)).to(weight.device)
 
+    def _edit_model(self, fact):
         requests = self._format_fact_for_rome(fact)
-        hparams = ROMEHyperParams.from_json(f'hparams/ROME/{self._model_name}.json')
-        _, self._changed_weights = apply_rome_to_model(self._model, self._tokenizer, requests, hparams, return_orig_weights=True)
-
-        sys.path.remove('..')
-        os.chdir('../..')
+        if self._delta_restore:
+            self._apply_deltas(self._execute_rome(self._model, self._tokenizer, requests[0], self._hparams))
+        else:
+            _, self._changed_weights = self._apply_rome_to_model(self._model, self._tokenizer, requests, self._hparams, return_orig_weights=True)
 
 
 class MENDModelEditor(RomeStyleModelEditor):
 
     def __init__(self, query_executor):
         super().__init__(query_executor)
-
-    def edit_model(self, fact):
-        os.chdir('./memit')
-        sys.path.append('..')
         from baselines.mend import MENDHyperParams, MendRewriteExecutor
+        # The executor loads the MEND weights on its first edit and keeps them for the following ones
+        self._executor = MendRewriteExecutor()
+        self._hparams = MENDHyperParams.from_json(self._hparams_path('MEND'))
 
+    def _edit_model(self, fact):
         requests = self._format_fact_for_rome(fact)
-        hparams = MENDHyperParams.from_json(f'hparams/MEND/{self._model_name}.json')
-        _, self._changed_weights = MendRewriteExecutor().apply_to_model(self._model, self._tokenizer, requests, hparams, return_orig_weights=True)
-
-        sys.path.remove('..')
-        os.chdir('../..')
+        _, self._changed_weights = self._executor.apply_to_model(self._model, self._tokenizer, requests, self._hparams, return_orig_weights=True)
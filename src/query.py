@@ -1,16 +1,30 @@
+from record import Record, freeze, intern_id
 from relation import Relation
 from wikidata.utils import get_label, get_aliases
 
 
-class Query:
+class Query(Record):
 
-    def __init__(self, subject_id, relation, target_ids, phrase=None):
-        self._subject_id = subject_id
-        self._relation = relation
-        self._targets_ids = target_ids if type(target_ids) == list else [target_ids]
-        self._phrase = phrase
+    __slots__ = ('_subject_id', '_relation', '_targets_ids', '_phrase', '_prompt', '_answers')
+
+    def __init__(self, subject_id, relation, target_ids, phrase=None, prompt=None, answers=None):
+        self._set('_subject_id', intern_id(subject_id))
+        self._set('_relation', relation)
+        self._set('_targets_ids', freeze(target_ids))
+        self._set('_phrase', phrase)
+        # The prompt and answers are looked up once and kept, or taken as is when loaded from a dict
+        self._set('_prompt', prompt)
+        self._set('_answers', answers)
+
+    def _key(self):
+        return self._subject_id, self._relation, self._targets_ids, self._phrase
 
     def get_query_prompt(self):
+        if self._prompt is None:
+            self._set('_prompt', self._resolve_prompt())
+        return self._prompt
+
+    def _resolve_prompt(self):
         if self._phrase is None:
             return self._relation.phrase(get_label(self._subject_id))
         return self._phrase
@@ -23,25 +37,48 @@ class Query:
                 filtered_answers.append(answer)
         return filtered_answers
 
+    def _answer_targets(self):
+        return self._targets_ids
+
+    @staticmethod
+    def _is_entity(target):
+        return type(target) == str and target[0] == 'Q'
+
+    def get_answer_dicts(self):
+        if self._answers is None:
+            self._set('_answers', [{'value': get_label(target), 'aliases': get_aliases(target)}
+                                   if self._is_entity(target) else {'value': str(target), 'aliases': []}
+                                   for target in self._answer_targets()])
+        return self._answers
+
     def get_answers(self):
-        answers = []
-        for target in self._targets_ids:
-            if type(target) is str:
-                target_answer = [get_label(target)] + get_aliases(target)
-            else:
-                target_answer = [str(target)]
-            answers.append(self._filter_answers(target_answer))
-        return answers
+        return [self._filter_answers([answer['value']] + answer['aliases']) for answer in self.get_answer_dicts()]
+
+    def resolve(self):
+        self.get_query_prompt()
+        self.get_answer_dicts()
+        return self
+
+    def entity_ids(self):
+        return [self._subject_id] + [target for target in self._targets_ids if type(target) is str]
+
+    def unresolved_entity_ids(self):
+        # The entities still needed for looking up the prompt and the answers
+        ent_ids = []
+        if self._prompt is None:
+            ent_ids.append(self._subject_id)
+        if self._answers is None:
+            ent_ids.extend(target for target in self._answer_targets() if self._is_entity(target))
+        return ent_ids
 
     def to_dict(self):
         return {
             'prompt': self.get_query_prompt(),
-            'answers': [{'value': get_label(target), 'aliases': get_aliases(target)} if type(target) == str and target[0] == 'Q'
-                        else {'value': str(target), 'aliases': []} for target in self._targets_ids],
+            'answers': self.get_answer_dicts(),
             'query_type': 'regular',
             'subject_id': self._subject_id,
             'relation': self._relation.name,
-            'target_ids': self._targets_ids,
+            'target_ids': list(self._targets_ids),
             'phrase': self._phrase,
         }
 
@@ -51,42 +88,48 @@ class Query:
         relation = Relation[d['relation']]
         target_ids = d['target_ids']
         phrase = d['phrase']
+        prompt = d.get('prompt')
+        answers = d.get('answers')
         if d['query_type'] == 'regular':
-            return Query(subject_id, relation, target_ids, phrase)
+            return Query(subject_id, relation, target_ids, phrase, prompt, answers)
         elif d['query_type'] == 'two_hop':
             second_relation = Relation[d['second_relation']]
             second_hop_target_ids = d['second_hop_target_ids']
-            return TwoHopQuery(subject_id, relation, target_ids, second_relation, second_hop_target_ids, phrase)
+            return TwoHopQuery(subject_id, relation, target_ids, second_relation, second_hop_target_ids, phrase,
+                               prompt, answers)
         else:
             print('Unknown phrase type: ', d['query_type'])
 
 
 class TwoHopQuery(Query):
 
-    def __init__(self, subject_id, relation, target_ids, second_relation, second_hop_target_ids, phrase):
-        super().__init__(subject_id, relation, target_ids, phrase)
-        self._second_relation = second_relation
-        self._second_hop_target_ids = second_hop_target_ids if type(second_hop_target_ids) == list else [second_hop_target_ids]
+    __slots__ = ('_second_relation', '_second_hop_target_ids')
 
-    def get_query_prompt(self):
+    def __init__(self, subject_id, relation, target_ids, second_relation, second_hop_target_ids, phrase,
+                 prompt=None, answers=None):
+        super().__init__(subject_id, relation, target_ids, phrase, prompt, answers)
+        self._set('_second_relation', second_relation)
+        self._set('_second_hop_target_ids', freeze(second_hop_target_ids))
+
+    def _key(self):
+        return super()._key() + (self._second_relation, self._second_hop_target_ids)
+
+    def _resolve_prompt(self):
         return self._phrase
 
-    def get_answers(self):
-        answers = []
-        for target in self._second_hop_target_ids:
-            if type(target) is str:
-                target_answer = [get_label(target)] + get_aliases(target)
-            else:
-                target_answer = [str(target)]
-            answers.append(self._filter_answers(target_answer))
-        return answers
+    def _answer_targets(self):
+        return self._second_hop_target_ids
+
+    @staticmethod
+    def _is_entity(target):
+        return type(target) == str and len(target) >= 2 and target[0] == 'Q' and target[1].isdigit()
+
+    def entity_ids(self):
+        return super().entity_ids() + [target for target in self._second_hop_target_ids if type(target) is str]
 
     def to_dict(self):
         d = super().to_dict()
         d['query_type'] = 'two_hop'
         d['second_relation'] = self._second_relation.name
-        d['second_hop_target_ids'] = self._second_hop_target_ids
-        d['answers'] = [{'value': get_label(target), 'aliases': get_aliases(target)}
-                        if type(target) == str and len(target) >= 2 and target[0] == 'Q' and target[1].isdigit()
-                        else {'value': str(target), 'aliases': []} for target in self._second_hop_target_ids]
+        d['second_hop_target_ids'] = list(self._second_hop_target_ids)
         return d
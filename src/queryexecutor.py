@@ -1,5 +1,8 @@
+from collections import OrderedDict
+
 import torch
-from transformers import AutoTokenizer, GPT2LMHeadModel, GPTJForCausalLM, GPTNeoXForCausalLM, LlamaForCausalLM
+from transformers import AutoTokenizer, GPT2LMHeadModel, GPTJForCausalLM, GPTNeoXForCausalLM, LlamaForCausalLM, \
+    LogitsProcessor, LogitsProcessorList
 from utils import call_openai, process_generation
 
 
@@ -16,12 +19,47 @@ class QueryExecutor:
             self._model = model
         self._tokenizer = tokenizer
         self._prompt_context = ''
+        # Generations are cached per model state. Editing the weights moves to a new state, and restoring them goes
+        # back to the previous one, so generations from the unedited model are reused across edits.
+        self._generation_cache = OrderedDict()
+        self._generation_cache_size = 100000
+        self._model_states = [0]
+        self._next_model_state = 1
+        self._cache_hits = 0
+        self._cache_misses = 0
 
     def get_model(self):
         return self._model
 
     def set_model(self, model):
         self._model = model.to(self._device)
+        self._model_states = [self._new_model_state()]
+
+    def _new_model_state(self):
+        self._next_model_state += 1
+        return self._next_model_state - 1
+
+    def push_model_state(self):
+        self._model_states.append(self._new_model_state())
+
+    def pop_model_state(self):
+        if len(self._model_states) > 1:
+            self._model_states.pop()
+
+    def get_model_state(self):
+        return self._model_states[-1]
+
+    def cache_stats(self):
+        lookups = self._cache_hits + self._cache_misses
+        return {
+            'entries': len(self._generation_cache),
+            'hits': self._cache_hits,
+            'misses': self._cache_misses,
+            'hit_rate': self._cache_hits / lookups if lookups else 0.0,
+        }
+
+    def clear_cache(self):
+        self._generation_cache.clear()
 
     def get_tokenizer(self):
         return self._tokenizer
@@ -39,33 +77,373 @@ class QueryExecutor:
                 return False
         return True
 
+    def _stops_on_answers(self):
+        return False
+
+    def _cached_generations(self, queries, answer_length, generate):
+        # Unless generation stops once the answers appear, the answers are not part of the key and queries differing
+        # only by their targets share a generation
+        keys = [(self._prompt_context, query.get_query_prompt(), answer_length, self.get_model_state(),
+                 tuple(tuple(answer) for answer in query.get_answers()) if self._stops_on_answers() else None)
+                for query in queries]
+        # The values of the batch are kept aside, since evicting may drop keys of the batch itself
+        values = dict()
+        missing_keys = dict()
+        for key in keys:
+            if key in values or key in missing_keys:
+                self._cache_hits += 1
+            elif key in self._generation_cache:
+                self._generation_cache.move_to_end(key)
+                values[key] = self._generation_cache[key]
+                self._cache_hits += 1
+            else:
+                missing_keys[key] = None
+                self._cache_misses += 1
+        if missing_keys:
+            missing_keys = list(missing_keys)
+            prompts = [key[0] + key[1] for key in missing_keys]
+            answers = [key[4] for key in missing_keys]
+            generations = generate(prompts, [len(prompt) + answer_length for prompt in prompts], answers)
+            for key, generation in zip(missing_keys, generations):
+                values[key] = generation
+                self._generation_cache[key] = generation
+            while len(self._generation_cache) > self._generation_cache_size:
+                self._generation_cache.popitem(last=False)
+        return [values[key] for key in keys]
+
     def execute_query(self, query, answer_length=30):
-        prompt = self._prompt_context + query.get_query_prompt()
-        model_answer = self._generate_text(prompt, len(prompt) + answer_length)
+        def generate(prompts, lengths, answers):
+            return [self._generate_text(prompts[0], lengths[0], answers[0])]
+
+        model_answer = self._cached_generations([query], answer_length, generate)[0]
         model_answer = model_answer.replace(self._prompt_context, '', 1)
         print(f'query: {query.to_dict()}\nmodel answer: {model_answer}')
         return self._verify_answer(model_answer, query.get_answers())
 
+    def execute_queries(self, queries, answer_length=30):
+        # Same verdicts as calling execute_query on every query, with the generations done in batches where supported
+        model_answers = self._cached_generations(queries, answer_length, self._generate_texts)
+        verdicts = []
+        for query, model_answer in zip(queries, model_answers):
+            model_answer = model_answer.replace(self._prompt_context, '', 1)
+            print(f'query: {query.to_dict()}\nmodel answer: {model_answer}')
+            verdicts.append(self._verify_answer(model_answer, query.get_answers()))
+        return verdicts
+
     def get_model_name(self):
         raise NotImplementedError()  # Override in concrete classes
 
-    def _generate_text(self, prompt, length):
+    def _generate_text(self, prompt, length, answers=None):
         raise NotImplementedError()  # Override in concrete classes
 
+    def _generate_texts(self, prompts, lengths, answers=None):
+        if answers is None:
+            answers = [None] * len(prompts)
+        return [self._generate_text(prompt, length, prompt_answers)
+                for prompt, length, prompt_answers in zip(prompts, lengths, answers)]
+
+
+class AnswerStoppingLogitsProcessor(LogitsProcessor):
+
+    # Sequences that are done are forced to emit the end of sequence token, which finishes them one by one within a
+    # batch, while the stopping criteria of generate can only stop the whole batch
+    TERMINATORS = ['\n', '.']
+
+    def __init__(self, tokenizer, prompt_width, answers, prompt_context, stop_at_terminators):
+        self._tokenizer = tokenizer
+        self._prompt_width = prompt_width
+        self._answers = answers
+        self._prompt_context = prompt_context
+        self._stop_at_terminators = stop_at_terminators
+        self._done = [False] * len(answers)
+        # The prompt of every row is decoded once, later steps only decode the generated tokens
+        self._prompt_texts = [None] * len(answers)
+
+    def __call__(self, input_ids, scores):
+        for row in range(input_ids.shape[0]):
+            if not self._done[row]:
+                self._done[row] = self._row_done(row, input_ids[row])
+            if self._done[row]:
+                scores[row, :] = -float('inf')
+                scores[row, self._tokenizer.eos_token_id] = 0
+        return scores
+
+    def _row_done(self, row, row_ids):
+        generated = self._tokenizer.decode(row_ids[self._prompt_width:], skip_special_tokens=True)
+        answers = self._answers[row]
+        if answers is not None:
+            if self._prompt_texts[row] is None:
+                prompt_text = self._tokenizer.decode(row_ids[:self._prompt_width], skip_special_tokens=True)
+                self._prompt_texts[row] = prompt_text.replace(self._prompt_context, '', 1)
+            # The text _verify_answer checks, once every target is matched more tokens can not change the verdict
+            model_answer = self._prompt_texts[row] + generated
+            if all(True in [possible_answer in model_answer for possible_answer in answer] for answer in answers):
+                return True
+        if self._stop_at_terminators:
+            return any(terminator in generated.lstrip() for terminator in self.TERMINATORS)
+        return False
+
 
 class HFQueryExecutor(QueryExecutor):
 
-    def __init__(self, model=None, tokenizer=None, device=None, send_to_device=True):
+    GENERATE_SCORING = 'generate'
+    LOGITS_SCORING = 'logits'
+    GREEDY_DECISION = 'greedy'
+    THRESHOLD_DECISION = 'threshold'
+    DEFAULT_ANSWER_TOKENS = 30
+
+    def __init__(self, model=None, tokenizer=None, device=None, send_to_device=True,
+                 max_batch_tokens=4096, max_batch_size=32):
         super().__init__(model, tokenizer, device, send_to_device)
+        self._max_batch_tokens = max_batch_tokens
+        self._max_batch_size = max_batch_size
+        self._scoring = self.GENERATE_SCORING
+        self._decision_rule = self.GREEDY_DECISION
+        self._threshold = None
+        self._score_cache = OrderedDict()
+        self._answer_tokens = self.DEFAULT_ANSWER_TOKENS
+        self._stop_on_answers = True
+        self._stop_at_terminators = False
+        # The prompt context (the in-context edit) is encoded once per context and model state, and its keys and
+        # values are shared by every prompt starting with it
+        self._reuse_prefix = True
+        self._prefix_cache = OrderedDict()
+        self._prefix_cache_size = 8
 
     def get_model_name(self):
         raise NotImplementedError()  # Override in concrete classes
 
-    def _generate_text(self, prompt, length):
+    def set_batch_limits(self, max_batch_tokens, max_batch_size):
+        self._max_batch_tokens = max_batch_tokens
+        self._max_batch_size = max_batch_size
+
+    def set_scoring(self, scoring=GENERATE_SCORING, decision_rule=GREEDY_DECISION, threshold=-1.0):
+        # With logits scoring an answer is accepted if it is the greedy continuation of the prompt, or if its mean
+        # token log-probability is at least the threshold
+        if scoring not in [self.GENERATE_SCORING, self.LOGITS_SCORING]:
+            raise ValueError(f'Unknown scoring {scoring}')
+        if decision_rule not in [self.GREEDY_DECISION, self.THRESHOLD_DECISION]:
+            raise ValueError(f'Unknown decision rule {decision_rule}')
+        self._scoring = scoring
+        self._decision_rule = decision_rule
+        self._threshold = threshold
+
+    def set_generation_limits(self, answer_tokens=DEFAULT_ANSWER_TOKENS, stop_on_answers=True,
+                              stop_at_terminators=False):
+        # answer_tokens bounds the number of generated tokens, when None the legacy bound of the prompt length in
+        # characters plus answer_length is used. Stopping on answers never changes a verdict, stopping at a newline
+        # or a period ignores anything the model would have answered after it.
+        self._answer_tokens = answer_tokens
+        self._stop_on_answers = stop_on_answers
+        self._stop_at_terminators = stop_at_terminators
+        self.clear_cache()
+
+    def _stops_on_answers(self):
+        return self._stop_on_answers
+
+    def _logits_processor(self, prompt_width, answers):
+        if not self._stop_on_answers and not self._stop_at_terminators:
+            return None
+        return LogitsProcessorList([AnswerStoppingLogitsProcessor(self._tokenizer, prompt_width, answers,
+                                                                  self._prompt_context, self._stop_at_terminators)])
+
+    def set_prefix_reuse(self, reuse_prefix):
+        self._reuse_prefix = reuse_prefix
+
+    def clear_cache(self):
+        super().clear_cache()
+        self._score_cache.clear()
+        self._prefix_cache.clear()
+
+    def execute_query(self, query, answer_length=30):
+        if self._scoring == self.LOGITS_SCORING:
+            return self._execute_queries_by_logits([query])[0]
+        return super().execute_query(query, answer_length)
+
+    def execute_queries(self, queries, answer_length=30):
+        if self._scoring == self.LOGITS_SCORING:
+            return self._execute_queries_by_logits(queries)
+        return super().execute_queries(queries, answer_length)
+
+    def _accept(self, score):
+        mean_log_prob, is_greedy = score
+        if self._decision_rule == self.GREEDY_DECISION:
+            return is_greedy
+        return mean_log_prob >= self._threshold
+
+    def _execute_queries_by_logits(self, queries):
+        # Like _verify_answer, every target needs one of its label and aliases to be accepted
+        prompts = [self._prompt_context + query.get_query_prompt() for query in queries]
+        answers = [query.get_answers() for query in queries]
+        candidates = list(dict.fromkeys((prompt, possible_answer) for prompt, query_answers in zip(prompts, answers)
+                                        for answer in query_answers for possible_answer in answer))
+        scores = dict(zip(candidates, self._cached_answer_scores(candidates)))
+        verdicts = []
+        for query, prompt, query_answers in zip(queries, prompts, answers):
+            answer_scores = {possible_answer: scores[(prompt, possible_answer)][0]
+                             for answer in query_answers for possible_answer in answer}
+            print(f'query: {query.to_dict()}\nanswer log-probs: {answer_scores}')
+            verdicts.append(all(any(self._accept(scores[(prompt, possible_answer)]) for possible_answer in answer)
+                                for answer in query_answers))
+        return verdicts
+
+    def _cached_answer_scores(self, candidates):
+        keys = [(prompt, answer, self.get_model_state()) for prompt, answer in candidates]
+        values = dict()
+        for key in keys:
+            if key not in values and key in self._score_cache:
+                self._score_cache.move_to_end(key)
+                values[key] = self._score_cache[key]
+        missing_keys = list(dict.fromkeys(key for key in keys if key not in values))
+        self._cache_hits += len(keys) - len(missing_keys)
+        self._cache_misses += len(missing_keys)
+        if missing_keys:
+            for key, score in zip(missing_keys, self._answer_scores([key[:2] for key in missing_keys])):
+                values[key] = score
+                self._score_cache[key] = score
+            while len(self._score_cache) > self._generation_cache_size:
+                self._score_cache.popitem(last=False)
+        return [values[key] for key in keys]
+
+    def _answer_scores(self, candidates):
+        # Teacher forced scoring of '<prompt> <answer>', the answer tokens are the ones following the prompt tokens
+        prompt_lengths = [len(self._tokenizer.encode(prompt)) for prompt, _ in candidates]
+        sequences_ids = [self._tokenizer.encode(f'{prompt} {answer}') for prompt, answer in candidates]
+        pad_token_id = self._tokenizer.pad_token_id
+        scores = [None] * len(candidates)
+        for batch in self._batches(sequences_ids, [0] * len(candidates)):
+            width = max(len(sequences_ids[i]) for i in batch)
+            input_ids = torch.tensor([sequences_ids[i] + [pad_token_id] * (width - len(sequences_ids[i]))
+                                      for i in batch])
+            attention_mask = torch.tensor([[1] * len(sequences_ids[i]) + [0] * (width - len(sequences_ids[i]))
+                                           for i in batch])
+            with torch.no_grad():
+                logits = self._model(input_ids=input_ids.to(self._device),
+                                     attention_mask=attention_mask.to(self._device)).logits.float()
+            for row, i in enumerate(batch):
+                start, end = prompt_lengths[i], len(sequences_ids[i])
+                if end <= start:
+                    scores[i] = (float('-inf'), False)
+                    continue
+                answer_ids = torch.tensor(sequences_ids[i][start:end], device=logits.device)
+                answer_logits = logits[row, start - 1:end - 1]
+                log_probs = torch.log_softmax(answer_logits, dim=-1).gather(1, answer_ids.unsqueeze(1)).squeeze(1)
+                scores[i] = (log_probs.mean().item(), bool((answer_logits.argmax(dim=-1) == answer_ids).all().item()))
+        return scores
+
+    def _max_new_tokens(self, prompt_ids, length):
+        if self._answer_tokens is not None:
+            return self._answer_tokens
+        # The legacy bound on the whole sequence, kept per prompt as a number of new tokens
+        return max(1, length - len(prompt_ids))
+
+    def _generate_text(self, prompt, length, answers=None):
+        if self._prompt_context and self._reuse_prefix:
+            return self._generate_texts([prompt], [length], [answers])[0]
         inputs = self._tokenizer.encode(prompt, return_tensors='pt').to(self._device)
-        outputs = self._model.generate(inputs, temperature=0, max_length=length)
+        outputs = self._model.generate(inputs, temperature=0,
+                                       max_new_tokens=self._max_new_tokens(inputs[0], length),
+                                       logits_processor=self._logits_processor(inputs.shape[1], [answers]))
         return self._tokenizer.decode(outputs[0], skip_special_tokens=True)
 
+    def _batches(self, prompts_ids, max_new_tokens):
+        # Prompts of similar lengths are batched together, as long as the padded batch fits in the token budget
+        order = sorted(range(len(prompts_ids)), key=lambda i: len(prompts_ids[i]))
+        batch, batch_prompt_length, batch_new_tokens = [], 0, 0
+        for i in order:
+            prompt_length = max(batch_prompt_length, len(prompts_ids[i]))
+            new_tokens = max(batch_new_tokens, max_new_tokens[i])
+            if batch and (len(batch) >= self._max_batch_size or
+                          (len(batch) + 1) * (prompt_length + new_tokens) > self._max_batch_tokens):
+                yield batch
+                batch, prompt_length, new_tokens = [], len(prompts_ids[i]), max_new_tokens[i]
+            batch.append(i)
+            batch_prompt_length, batch_new_tokens = prompt_length, new_tokens
+        if batch:
+            yield batch
+
+    def _generate_texts(self, prompts, lengths, answers=None):
+        if answers is None:
+            answers = [None] * len(prompts)
+        prompts_ids = [self._tokenizer.encode(prompt) for prompt in prompts]
+        max_new_tokens = [self._max_new_tokens(prompt_ids, length) for prompt_ids, length in zip(prompts_ids, lengths)]
+        context_ids, context_past = None, None
+        if self._prompt_context and self._reuse_prefix:
+            context_ids, context_past = self._context_prefix()
+        texts = [None] * len(prompts)
+        for batch in self._batches(prompts_ids, max_new_tokens):
+            batch_ids = [prompts_ids[i] for i in batch]
+            batch_new_tokens = max(max_new_tokens[i] for i in batch)
+            batch_answers = [answers[i] for i in batch]
+            # The context tokens may merge with the prompt tokens, in which case the prompt is encoded from scratch
+            if context_ids is not None and all(len(prompt_ids) > len(context_ids) and
+                                               prompt_ids[:len(context_ids)] == context_ids for prompt_ids in batch_ids):
+                outputs, width = self._generate_batch_with_prefix(batch_ids, context_ids, context_past,
+                                                                  batch_new_tokens, batch_answers)
+            else:
+                outputs, width = self._generate_batch(batch_ids, batch_new_tokens, batch_answers)
+            for row, i in enumerate(batch):
+                # Greedy decoding, so cutting a longer generation gives the tokens a shorter one would have
+                generated = outputs[row, width:width + max_new_tokens[i]].tolist()
+                texts[i] = self._tokenizer.decode(prompts_ids[i] + generated, skip_special_tokens=True)
+        return texts
+
+    def _generate_batch(self, batch_ids, max_new_tokens, answers):
+        pad_token_id = self._tokenizer.pad_token_id
+        width = max(len(prompt_ids) for prompt_ids in batch_ids)
+        input_ids = torch.tensor([[pad_token_id] * (width - len(prompt_ids)) + prompt_ids for prompt_ids in batch_ids])
+        attention_mask = torch.tensor([[0] * (width - len(prompt_ids)) + [1] * len(prompt_ids)
+                                       for prompt_ids in batch_ids])
+        outputs = self._model.generate(input_ids.to(self._device), attention_mask=attention_mask.to(self._device),
+                                       temperature=0, max_new_tokens=max_new_tokens, pad_token_id=pad_token_id,
+                                       logits_processor=self._logits_processor(width, answers))
+        return outputs, width
+
+    def _context_prefix(self):
+        key = (self._prompt_context, self.get_model_state())
+        if key not in self._prefix_cache:
+            context_ids = self._tokenizer.encode(self._prompt_context)
+            with torch.no_grad():
+                context_past = self._model(torch.tensor([context_ids], device=self._device),
+                                           use_cache=True).past_key_values
+            self._prefix_cache[key] = (context_ids, context_past)
+            while len(self._prefix_cache) > self._prefix_cache_size:
+                self._prefix_cache.popitem(last=False)
+        self._prefix_cache.move_to_end(key)
+        return self._prefix_cache[key]
+
+    def _generate_batch_with_prefix(self, batch_ids, context_ids, context_past, max_new_tokens, answers):
+        # Rows are the context, then padding, then the rest of the prompt, so the context keys and values are shared.
+        # They are expanded over the batch without copying, and the model concatenates new keys and values into new
+        # tensors, so the cached ones are never written to.
+        pad_token_id = self._tokenizer.pad_token_id
+        context_length = len(context_ids)
+        suffixes = [prompt_ids[context_length:] for prompt_ids in batch_ids]
+        suffix_width = max(len(suffix) for suffix in suffixes)
+        input_ids = torch.tensor([context_ids + [pad_token_id] * (suffix_width - len(suffix)) + suffix
+                                  for suffix in suffixes], device=self._device)
+        attention_mask = torch.tensor([[1] * context_length + [0] * (suffix_width - len(suffix)) + [1] * len(suffix)
+                                       for suffix in suffixes], device=self._device)
+        past = tuple(tuple(tensor.expand(len(batch_ids), *tensor.shape[1:]) for tensor in layer)
+                     for layer in context_past)
+
+        # Encode everything but the last prompt token, which generate feeds to the model with the cached past
+        if suffix_width > 1:
+            position_ids = attention_mask.long().cumsum(-1) - 1
+            position_ids.masked_fill_(attention_mask == 0, 1)
+            with torch.no_grad():
+                past = self._model(input_ids=input_ids[:, context_length:-1],
+                                   attention_mask=attention_mask[:, :-1],
+                                   position_ids=position_ids[:, context_length:-1],
+                                   past_key_values=past,
+                                   use_cache=True).past_key_values
+
+        width = context_length + suffix_width
+        outputs = self._model.generate(input_ids, attention_mask=attention_mask, past_key_values=past,
+                                       temperature=0, max_new_tokens=max_new_tokens, pad_token_id=pad_token_id,
+                                       logits_processor=self._logits_processor(width, answers))
+        return outputs, width
+
 
 class GPT2QueryExecutor(HFQueryExecutor):
 
@@ -136,7 +514,7 @@ class GPT3QueryExecutor(QueryExecutor):
     def get_model_name(self):
         return self._model_size
 
-    def _generate_text(self, prompt, length):
+    def _generate_text(self, prompt, length, answers=None):
         text, log_probs = call_openai(
             prompt=prompt,
             model=self._model_size,
@@ -0,0 +1,55 @@
+import sys
+
+
+def intern_id(value):
+    # Entity ids repeat across the whole benchmark, interning keeps a single copy of every id string
+    return sys.intern(value) if type(value) is str else value
+
+
+def freeze(values):
+    if type(values) in (list, tuple):
+        return tuple(intern_id(value) for value in values)
+    return intern_id(values),
+
+
+# Base for slotted immutable records, which are compared and hashed by the tuple returned from _key
+class Record:
+
+    __slots__ = ('_hash',)
+
+    def _key(self):
+        raise NotImplementedError
+
+    def _set(self, name, value):
+        object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f'{type(self).__name__} is immutable')
+
+    def __delattr__(self, name):
+        raise AttributeError(f'{type(self).__name__} is immutable')
+
+    def __eq__(self, other):
+        if self is other:
+            return True
+        if type(other) is not type(self):
+            return NotImplemented
+        return hash(self) == hash(other) and self._key() == other._key()
+
+    def __hash__(self):
+        try:
+            return self._hash
+        except AttributeError:
+            self._set('_hash', hash((type(self).__name__,) + self._key()))
+            return self._hash
+
+    def _slots(self):
+        for cls in type(self).__mro__:
+            yield from getattr(cls, '__slots__', ())
+
+    def __getstate__(self):
+        return {name: getattr(self, name) for name in self._slots() if name != '_hash' and hasattr(self, name)}
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            self._set(name, value)
@@ -1,20 +1,26 @@
+from record import Record
 from src.query import Query
 
 
-class TestCase:
+class TestCase(Record):
 
     OR_TEST_CONDITION = 'OR'
     AND_TEST_CONDITION = 'AND'
 
+    __slots__ = ('_test_queries', '_condition_queries', '_test_condition')
+
     def __init__(self, test_query, condition_queries=None, test_condition=OR_TEST_CONDITION):
         if condition_queries is None:
             condition_queries = []
-        if type(test_query) is list:
-            self._test_queries = test_query
+        if type(test_query) in (list, tuple):
+            self._set('_test_queries', tuple(test_query))
         else:
-            self._test_queries = [test_query]
-        self._condition_queries = condition_queries
-        self._test_condition = test_condition
+            self._set('_test_queries', (test_query,))
+        self._set('_condition_queries', tuple(condition_queries))
+        self._set('_test_condition', test_condition)
+
+    def _key(self):
+        return self._test_queries, self._condition_queries, self._test_condition
 
     def get_test_queries(self):
         return self._test_queries
@@ -25,6 +31,23 @@ class TestCase:
     def get_condition_queries(self):
         return self._condition_queries
 
+    def entity_ids(self):
+        ent_ids = []
+        for query in self._test_queries + self._condition_queries:
+            ent_ids.extend(query.entity_ids())
+        return ent_ids
+
+    def unresolved_entity_ids(self):
+        ent_ids = []
+        for query in self._test_queries + self._condition_queries:
+            ent_ids.extend(query.unresolved_entity_ids())
+        return ent_ids
+
+    def resolve(self):
+        for query in self._test_queries + self._condition_queries:
+            query.resolve()
+        return self
+
     def to_dict(self):
         return {
             'test_queries': [query.to_dict() for query in self._test_queries],
@@ -42,13 +65,11 @@ class TestCase:
     def __str__(self):
         res = 'Test Queries:\n'
         for query in self._test_queries:
-            query_dict = query.to_dict()
-            res += f"Query: {query_dict['prompt']}, " \
-                   f"Answer: {query_dict['answers'][0]['value']}\n"
+            res += f"Query: {query.get_query_prompt()}, " \
+                   f"Answer: {query.get_answer_dicts()[0]['value']}\n"
         res += f'Test Condition: {self._test_condition}\n'
         res += 'Condition Queries:\n'
         for query in self._condition_queries:
-            query_dict = query.to_dict()
-            res += f"Query: {query_dict['prompt']}, " \
-                   f"Answer: {query_dict['answers'][0]['value']}\n"
+            res += f"Query: {query.get_query_prompt()}, " \
+                   f"Answer: {query.get_answer_dicts()[0]['value']}\n"
         return res
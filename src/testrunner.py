@@ -1,5 +1,9 @@
+import os
+import time
 from enum import Enum, auto
 
+import torch
+
 from benchmark import RecentlyAddedExample, CounterFactualExample
 from testcase import TestCase
 
@@ -17,62 +21,383 @@ class ExampleResult(Enum):
     PREV_FACT_UNKNOWN = auto()
 
 
+class TestCaseResult:
+
+    def __init__(self, index: int, test_case: TestCase):
+        self.index = index
+        self.test_case = test_case
+        # None when the conditions held but the test queries were not run (no model editor)
+        self.status = None
+        self.condition_outcomes = []
+        self.test_outcomes = []
+        self.seconds = 0.0
+
+
+class RunResult:
+
+    def __init__(self, test_cases: list):
+        self.example_result = ExampleResult.EXECUTED
+        self.test_case_results = [TestCaseResult(i, test_case) for i, test_case in enumerate(test_cases)]
+        self.timings = {'conditions': 0.0, 'fact_check': 0.0, 'edit': 0.0, 'tests': 0.0, 'restore': 0.0}
+
+    def __len__(self):
+        return len(self.test_case_results)
+
+    def __iter__(self):
+        return iter(self.test_case_results)
+
+    def results(self, status: TestResult):
+        return [result for result in self.test_case_results if result.status == status]
+
+    def count(self, status: TestResult):
+        return sum(1 for result in self.test_case_results if result.status == status)
+
+    def test_cases(self, status: TestResult):
+        return [result.test_case for result in self.results(status)]
+
+    def executed_test_cases(self):
+        return [result.test_case for result in self.test_case_results if result.status != TestResult.NOT_EXECUTED]
+
+    def slice(self, start: int, end: int):
+        # The results of a contiguous range of the test cases, sharing the example result and timings of the run
+        run_result = RunResult([])
+        run_result.example_result = self.example_result
+        run_result.test_case_results = self.test_case_results[start:end]
+        run_result.timings = self.timings
+        return run_result
+
+
 class TestRunner:
 
     def __init__(self, query_executor, model_editor):
         self._query_executor = query_executor
         self._model_editor = model_editor
 
-    def run_testcases(self, example, test_cases, skip_edit=False, skip_restore=False, skip_preconditions=False):
-        example_result = ExampleResult.EXECUTED
-        test_results = {TestResult.NOT_EXECUTED: [], TestResult.PASSED: [], TestResult.FAILED: []}
+    def _execute_queries(self, queries_per_test_case: list):
+        # The queries of all the test cases are executed as one batch and split back per test case
+        queries = [query for test_case_queries in queries_per_test_case for query in test_case_queries]
+        outcomes = self._query_executor.execute_queries(queries) if queries else []
+        split_outcomes = []
+        start = 0
+        for test_case_queries in queries_per_test_case:
+            split_outcomes.append(outcomes[start:start + len(test_case_queries)])
+            start += len(test_case_queries)
+        return split_outcomes
 
-        # Check testcase conditions
-        if not skip_preconditions:
-            for test_case in test_cases:
-                for condition_query in test_case.get_condition_queries():
-                    print('Executing condition query')
-                    if not self._query_executor.execute_query(condition_query):
-                        test_results[TestResult.NOT_EXECUTED].append(test_case)
-                        break
+    @staticmethod
+    def _share_time(run_result, outcomes: list, seconds: float):
+        # Batched queries are not timed one by one, so every test case is charged by its share of the queries
+        total = sum(len(test_case_outcomes) for test_case_outcomes in outcomes)
+        if total == 0:
+            return
+        for result, test_case_outcomes in zip(run_result, outcomes):
+            result.seconds += seconds * len(test_case_outcomes) / total
+
+    def _check_conditions(self, run_results: list):
+        results = [result for run_result in run_results for result in run_result]
+        start = time.perf_counter()
+        print('Executing condition queries')
+        # The conditions are executed in rounds, the i-th round batching the i-th condition query of every test case
+        # whose earlier conditions held. A test case stops at its first failing condition, as if run one by one.
+        conditions = [result.test_case.get_condition_queries() for result in results]
+        pending = [i for i, condition_queries in enumerate(conditions) if condition_queries]
+        round_index = 0
+        while pending:
+            outcomes = self._execute_queries([[conditions[i][round_index]] for i in pending])
+            next_pending = []
+            for i, (outcome,) in zip(pending, outcomes):
+                results[i].condition_outcomes.append(outcome)
+                if not outcome:
+                    results[i].status = TestResult.NOT_EXECUTED
+                elif round_index + 1 < len(conditions[i]):
+                    next_pending.append(i)
+            pending = next_pending
+            round_index += 1
+        seconds = time.perf_counter() - start
+        for run_result in run_results:
+            run_result.timings['conditions'] = seconds
+        self._share_time(results, [result.condition_outcomes for result in results], seconds)
 
+    def _check_fact(self, example, run_result):
         # Check if fact is known/unknown according to example type
+        start = time.perf_counter()
         if isinstance(example, RecentlyAddedExample):
             print('Executing fact check query')
             if self._query_executor.execute_query(example.fact.get_fact_query()):
-                example_result = ExampleResult.NEW_FACT_KNOWN
+                run_result.example_result = ExampleResult.NEW_FACT_KNOWN
         elif isinstance(example, CounterFactualExample):
             print('Executing fact check query')
             if not self._query_executor.execute_query(example.previous_fact.get_fact_query()):
-                example_result = ExampleResult.PREV_FACT_UNKNOWN
+                run_result.example_result = ExampleResult.PREV_FACT_UNKNOWN
+        run_result.timings['fact_check'] += time.perf_counter() - start
+
+    def _check_edit(self, example, run_result):
+        if not self._query_executor.execute_query(example.fact.get_fact_query()):
+            run_result.example_result = ExampleResult.EDIT_FAILED
+
+    def _run_tests(self, run_results: list):
+        results = [result for run_result in run_results for result in run_result]
+        start = time.perf_counter()
+        print('Executing test queries')
+        outcomes = self._execute_queries([result.test_case.get_test_queries()
+                                          if result.status != TestResult.NOT_EXECUTED else []
+                                          for result in results])
+        for result, test_outcomes in zip(results, outcomes):
+            if result.status == TestResult.NOT_EXECUTED:
+                continue
+            result.test_outcomes = test_outcomes
+            test_condition = result.test_case.get_test_condition()
+            if test_condition == TestCase.OR_TEST_CONDITION and True in result.test_outcomes:
+                result.status = TestResult.PASSED
+            elif test_condition == TestCase.AND_TEST_CONDITION and False not in result.test_outcomes:
+                result.status = TestResult.PASSED
+            else:
+                result.status = TestResult.FAILED
+        seconds = time.perf_counter() - start
+        for run_result in run_results:
+            run_result.timings['tests'] = seconds
+        self._share_time(results, outcomes, seconds)
+
+    def run_testcases(self, example, test_cases, skip_edit=False, skip_restore=False, skip_preconditions=False):
+        run_result = RunResult(test_cases)
+
+        # Check testcase conditions
+        if not skip_preconditions:
+            self._check_conditions([run_result])
+
+        self._check_fact(example, run_result)
 
         if self._model_editor is None:
-            return example_result, test_results
+            return run_result
 
         # Modify model
+        start = time.perf_counter()
         if not skip_edit:
             self._model_editor.edit_model(example.fact)
 
         # Test edit
-        if not self._query_executor.execute_query(example.fact.get_fact_query()):
-            example_result = ExampleResult.EDIT_FAILED
+        self._check_edit(example, run_result)
+        run_result.timings['edit'] = time.perf_counter() - start
 
         # Test modified model
-        for test_case in test_cases:
-            if test_case not in test_results[TestResult.NOT_EXECUTED]:
-                test_case_results = []
-                for test_query in test_case.get_test_queries():
-                    print('Executing test query')
-                    test_case_results.append(self._query_executor.execute_query(test_query))
-                if test_case.get_test_condition() == TestCase.OR_TEST_CONDITION and True in test_case_results:
-                    test_results[TestResult.PASSED].append(test_case)
-                elif test_case.get_test_condition() == TestCase.AND_TEST_CONDITION and False not in test_case_results:
-                    test_results[TestResult.PASSED].append(test_case)
-                else:
-                    test_results[TestResult.FAILED].append(test_case)
+        self._run_tests([run_result])
 
         # Restore model
         if not skip_restore:
+            start = time.perf_counter()
             self._model_editor.restore_model()
+            run_result.timings['restore'] = time.perf_counter() - start
+
+        return run_result
+
+    def run_testcases_batch(self, examples: list, test_cases_per_example: list, skip_preconditions=False):
+        # The facts of all the examples are edited into the model at once and restored once, so the tests of every
+        # example run against a model holding the whole batch of edits. The run results share the batch timings.
+        run_results = [RunResult(test_cases) for test_cases in test_cases_per_example]
+        timings = run_results[0].timings
+        for run_result in run_results:
+            run_result.timings = timings
+
+        if not skip_preconditions:
+            self._check_conditions(run_results)
+
+        for example, run_result in zip(examples, run_results):
+            self._check_fact(example, run_result)
+
+        if self._model_editor is None:
+            return run_results
+
+        start = time.perf_counter()
+        self._model_editor.edit_model_batch([example.fact for example in examples])
+        for example, run_result in zip(examples, run_results):
+            self._check_edit(example, run_result)
+        timings['edit'] = time.perf_counter() - start
+
+        self._run_tests(run_results)
+
+        start = time.perf_counter()
+        self._model_editor.restore_model()
+        timings['restore'] = time.perf_counter() - start
+
+        return run_results
+
+
+class SequentialRunResult:
+
+    def __init__(self, first_edit: int, edit_latencies: list):
+        # Edits already in the model when the run started, when it was resumed from a checkpoint. Their run results
+        # are restored from the checkpoint, with the statuses but without the query outcomes.
+        self.first_edit = first_edit
+        # The run result of every edit of the stream, with its tests run right after it
+        self.run_results = []
+        # Pairs of the number of edits in the model and the run results of all of them at that point
+        self.reevaluations = []
+        # The seconds of every edit in the stream, edit_latencies[i] being the latency of edit i + 1
+        self.edit_latencies = edit_latencies
+
+
+class SequentialTestRunner(TestRunner):
+
+    # Edits accumulate in the model instead of being restored after their tests. Earlier edits are re-evaluated every
+    # reevaluate_every edits, and the accumulated weight deltas are checkpointed every checkpoint_every edits, so a
+    # long stream of edits can be resumed.
+
+    def __init__(self, query_executor, model_editor):
+        if model_editor is None or not model_editor.CHANGES_WEIGHTS:
+            raise ValueError('Sequential editing requires a model editor that changes the model weights')
+        super().__init__(query_executor, model_editor)
+        self._original_weights = dict()
+        # Originals recomputed from delta factors only approximate the weights before the edits
+        self._exact_originals = True
+        self._edits = 0
+        self._edit_latencies = []
+        # Whether each test case of every edit was executed, as decided by its conditions when the edit was made
+        self._executed = []
+        # The statuses of every edit and of every re-evaluation, which are checkpointed with the deltas
+        self._outcomes = []
+        self._reevaluation_outcomes = []
+        self._pushed_model_states = 0
+
+    def get_edits_count(self):
+        return self._edits
+
+    def _keep_edit(self):
+        pre_edit_weights, exact = self._model_editor.get_pre_edit_weights()
+        for name, weight in pre_edit_weights.items():
+            # A weight is first changed by the edit that reports it, so its pre edit value is the original one
+            if name not in self._original_weights:
+                self._original_weights[name] = weight.detach().cpu().clone()
+                self._exact_originals = self._exact_originals and exact
+        self._model_editor.keep_edit()
+        self._pushed_model_states += 1
+        self._edits += 1
+
+    @staticmethod
+    def _outcome(run_result):
+        return {
+            'example_result': run_result.example_result.name,
+            'statuses': [None if result.status is None else result.status.name for result in run_result],
+        }
+
+    @staticmethod
+    def _run_result(outcome, test_cases):
+        run_result = RunResult(test_cases)
+        run_result.example_result = ExampleResult[outcome['example_result']]
+        for result, status in zip(run_result, outcome['statuses']):
+            result.status = None if status is None else TestResult[status]
+        return run_result
+
+    def _reevaluate(self, examples: list, test_cases_per_example: list):
+        run_results = []
+        for example, test_cases, executed in zip(examples, test_cases_per_example, self._executed):
+            run_result = RunResult(test_cases)
+            for result, was_executed in zip(run_result, executed):
+                if not was_executed:
+                    result.status = TestResult.NOT_EXECUTED
+            self._check_edit(example, run_result)
+            run_results.append(run_result)
+        self._run_tests(run_results)
+        return run_results
+
+    def run_sequential(self, examples: list, test_cases_per_example: list, reevaluate_every: int = 0,
+                       checkpoint_every: int = 0, checkpoint_path=None):
+        # Resuming skips the examples whose edits are already in the checkpoint
+        if checkpoint_path is not None and os.path.exists(checkpoint_path) and self._edits == 0:
+            self.load_checkpoint(checkpoint_path)
+        sequential_result = SequentialRunResult(self._edits, self._edit_latencies)
+        sequential_result.run_results = [self._run_result(outcome, test_cases)
+                                         for outcome, test_cases in zip(self._outcomes, test_cases_per_example)]
+        sequential_result.reevaluations = [(edits, [self._run_result(outcome, test_cases)
+                                                    for outcome, test_cases in zip(outcomes, test_cases_per_example)])
+                                           for edits, outcomes in self._reevaluation_outcomes]
+
+        for example, test_cases in zip(examples[self._edits:], test_cases_per_example[self._edits:]):
+            run_result = RunResult(test_cases)
+
+            # Conditions and the fact are checked against the model holding all the previous edits
+            self._check_conditions([run_result])
+            self._check_fact(example, run_result)
+
+            start = time.perf_counter()
+            self._model_editor.edit_model(example.fact)
+            latency = time.perf_counter() - start
+            self._keep_edit()
+            self._edit_latencies.append(latency)
+
+            start = time.perf_counter()
+            self._check_edit(example, run_result)
+            run_result.timings['edit'] = latency + time.perf_counter() - start
+            self._run_tests([run_result])
+            self._executed.append([result.status != TestResult.NOT_EXECUTED for result in run_result])
+            sequential_result.run_results.append(run_result)
+            self._outcomes.append(self._outcome(run_result))
+
+            if reevaluate_every and self._edits % reevaluate_every == 0:
+                print(f'Re-evaluating {self._edits} edits')
+                run_results = self._reevaluate(examples[:self._edits], test_cases_per_example[:self._edits])
+                sequential_result.reevaluations.append((self._edits, run_results))
+                self._reevaluation_outcomes.append((self._edits, [self._outcome(run_res) for run_res in run_results]))
+
+            if checkpoint_path is not None and checkpoint_every and self._edits % checkpoint_every == 0:
+                self.save_checkpoint(checkpoint_path)
+
+        if checkpoint_path is not None:
+            self.save_checkpoint(checkpoint_path)
+        return sequential_result
+
+    def save_checkpoint(self, checkpoint_path):
+        model = self._query_executor.get_model()
+        with torch.no_grad():
+            deltas = {name: model.get_parameter(name).detach().cpu() - weight
+                      for name, weight in self._original_weights.items()}
+        checkpoint = {
+            'edits': self._edits,
+            'deltas': deltas,
+            'edit_latencies': self._edit_latencies,
+            'executed': self._executed,
+            'outcomes': self._outcomes,
+            'reevaluation_outcomes': self._reevaluation_outcomes,
+        }
+        # Written aside and renamed, so an interrupted save leaves the previous checkpoint intact
+        torch.save(checkpoint, f'{checkpoint_path}.tmp')
+        os.replace(f'{checkpoint_path}.tmp', checkpoint_path)
+        print(f'Saved checkpoint of {self._edits} edits to {checkpoint_path}')
+
+    def load_checkpoint(self, checkpoint_path):
+        # Adds the checkpointed deltas to the model, which must not hold any edit
+        checkpoint = torch.load(checkpoint_path, map_location='cpu')
+        model = self._query_executor.get_model()
+        with torch.no_grad():
+            for name, delta in checkpoint['deltas'].items():
+                weight = model.get_parameter(name)
+                self._original_weights[name] = weight.detach().cpu().clone()
+                weight[...] += delta.to(weight.device)
+        self._query_executor.push_model_state()
+        self._pushed_model_states += 1
+        self._edits = checkpoint['edits']
+        self._edit_latencies = checkpoint['edit_latencies']
+        self._executed = checkpoint['executed']
+        self._outcomes = checkpoint['outcomes']
+        self._reevaluation_outcomes = checkpoint['reevaluation_outcomes']
+        print(f'Resumed {self._edits} edits from {checkpoint_path}')
 
-        return example_result, test_results
+    def restore_model(self):
+        # Removes all the accumulated edits, returning the query executor to the model state of the unedited model
+        model = self._query_executor.get_model()
+        with torch.no_grad():
+            for name, weight in self._original_weights.items():
+                parameter = model.get_parameter(name)
+                parameter[...] = weight.to(parameter.device)
+        for _ in range(self._pushed_model_states):
+            self._query_executor.pop_model_state()
+        if not self._exact_originals:
+            # The generations cached for the unedited model are not reused for approximately restored weights
+            self._query_executor.push_model_state()
+        self._original_weights = dict()
+        self._exact_originals = True
+        self._edits = 0
+        self._edit_latencies = []
+        self._executed = []
+        self._outcomes = []
+        self._reevaluation_outcomes = []
+        self._pushed_model_states = 0
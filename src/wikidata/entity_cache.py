@@ -0,0 +1,209 @@
+import argparse
+import json
+import sqlite3
+import threading
+import time
+import zlib
+
+
+class EntityCache:
+
+    # Ids are looked up in chunks, below the limit sqlite puts on the number of query parameters
+    _CHUNK_SIZE = 500
+
+    def __init__(self, path: str, max_entries: int = 1000000, ttl: float = None, touch_every: int = 1000):
+        self._path = path
+        self._max_entries = max_entries
+        self._ttl = ttl
+        # Access times of hits are buffered and written every touch_every hits, before evicting and on close
+        self._touch_every = touch_every
+        self._touches = dict()
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.execute('CREATE TABLE IF NOT EXISTS entities '
+                                 '(id TEXT PRIMARY KEY, data BLOB, fetched_at REAL, accessed_at REAL)')
+        self._connection.execute('CREATE INDEX IF NOT EXISTS entities_accessed_at ON entities (accessed_at)')
+        # The number of entries is kept next to them, so opening the cache does not count the whole table
+        self._connection.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER)')
+        row = self._connection.execute("SELECT value FROM meta WHERE key = 'size'").fetchone()
+        if row is None:
+            self._size = self._connection.execute('SELECT COUNT(*) FROM entities').fetchone()[0]
+            self._save_size()
+        else:
+            self._size = row[0]
+        self._connection.commit()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _save_size(self):
+        self._connection.execute("INSERT OR REPLACE INTO meta VALUES ('size', ?)", (self._size,))
+
+    def _flush_touches(self):
+        if not self._touches:
+            return
+        self._connection.executemany('UPDATE entities SET accessed_at = ? WHERE id = ?',
+                                     [(accessed_at, ent_id) for ent_id, accessed_at in self._touches.items()])
+        self._connection.commit()
+        self._touches = dict()
+
+    def _is_expired(self, fetched_at: float, now: float):
+        return self._ttl is not None and now - fetched_at > self._ttl
+
+    def get(self, ent_id: str):
+        now = time.time()
+        with self._lock:
+            row = self._connection.execute('SELECT data, fetched_at FROM entities WHERE id = ?', (ent_id,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            data, fetched_at = row
+            if self._is_expired(fetched_at, now):
+                self._connection.execute('DELETE FROM entities WHERE id = ?', (ent_id,))
+                self._touches.pop(ent_id, None)
+                self._size -= 1
+                self._save_size()
+                self._connection.commit()
+                self.evictions += 1
+                self.misses += 1
+                return None
+            self._touches[ent_id] = now
+            if len(self._touches) >= self._touch_every:
+                self._flush_touches()
+            self.hits += 1
+        return json.loads(zlib.decompress(data))
+
+    def put(self, ent_id: str, entity_dict: dict):
+        self.put_many({ent_id: entity_dict})
+
+    def put_many(self, entity_dicts: dict):
+        if not entity_dicts:
+            return
+        now = time.time()
+        rows = [(ent_id, zlib.compress(json.dumps(entity_dict, ensure_ascii=False).encode('utf-8')), now, now)
+                for ent_id, entity_dict in entity_dicts.items()]
+        ent_ids = list(entity_dicts)
+        with self._lock:
+            existing = 0
+            for start in range(0, len(ent_ids), self._CHUNK_SIZE):
+                chunk = ent_ids[start:start + self._CHUNK_SIZE]
+                existing += self._connection.execute(
+                    f'SELECT COUNT(*) FROM entities WHERE id IN ({", ".join("?" * len(chunk))})', chunk).fetchone()[0]
+            self._connection.executemany('INSERT OR REPLACE INTO entities VALUES (?, ?, ?, ?)', rows)
+            for ent_id in ent_ids:
+                self._touches.pop(ent_id, None)
+            self._size += len(rows) - existing
+            self._save_size()
+            self._connection.commit()
+            self._evict()
+
+    def _evict(self):
+        if self._size <= self._max_entries:
+            return
+        self._flush_touches()
+        excess = self._size - self._max_entries
+        removed = self._connection.execute('DELETE FROM entities WHERE id IN '
+                                           '(SELECT id FROM entities ORDER BY accessed_at LIMIT ?)', (excess,)).rowcount
+        self._size -= removed
+        self._save_size()
+        self._connection.commit()
+        self.evictions += removed
+
+    def remove_expired(self):
+        if self._ttl is None:
+            return 0
+        with self._lock:
+            removed = self._connection.execute('DELETE FROM entities WHERE fetched_at < ?',
+                                               (time.time() - self._ttl,)).rowcount
+            self._size -= removed
+            self._save_size()
+            self._connection.commit()
+            self.evictions += removed
+        return removed
+
+    def missing_ids(self, ent_ids):
+        now = time.time()
+        missing = []
+        with self._lock:
+            for ent_id in ent_ids:
+                row = self._connection.execute('SELECT fetched_at FROM entities WHERE id = ?', (ent_id,)).fetchone()
+                if row is None or self._is_expired(row[0], now):
+                    missing.append(ent_id)
+        return missing
+
+    def __len__(self):
+        return self._size
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'size': self._size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / total if total else 0.0,
+        }
+
+    def close(self):
+        with self._lock:
+            self._flush_touches()
+            self._connection.close()
+
+
+def is_entity_id(value):
+    return isinstance(value, str) and len(value) >= 2 and value[0] == 'Q' and value[1:].isdigit()
+
+
+def collect_entity_ids(d, ent_ids=None):
+    if ent_ids is None:
+        ent_ids = set()
+    if isinstance(d, dict):
+        for key, value in d.items():
+            if key in ['subject_id', 'target_id', 'target_ids', 'second_hop_target_ids']:
+                values = value if isinstance(value, list) else [value]
+                ent_ids.update(v for v in values if is_entity_id(v))
+            else:
+                collect_entity_ids(value, ent_ids)
+    elif isinstance(d, list):
+        for value in d:
+            collect_entity_ids(value, ent_ids)
+    return ent_ids
+
+
+def warm_up(cache: EntityCache, benchmark_path: str, fetch, log_every: int = 100):
+    with open(benchmark_path, 'r', encoding='utf-8') as f:
+        benchmark = json.load(f)
+    ent_ids = sorted(collect_entity_ids(benchmark))
+    missing = cache.missing_ids(ent_ids)
+    print(f'{len(missing)}/{len(ent_ids)} referenced entities are missing from the cache')
+    failed = 0
+    for i, ent_id in enumerate(missing):
+        try:
+            cache.put(ent_id, fetch(ent_id))
+        except Exception as e:
+            print(f'Failed fetching {ent_id}: {e}')
+            failed += 1
+        if (i + 1) % log_every == 0:
+            print(f'{i + 1}/{len(missing)}')
+    print(f'Fetched {len(missing) - failed}/{len(missing)} entities')
+    return len(missing) - failed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    warmup_parser = subparsers.add_parser('warmup', help='Prefetch all entities referenced in a benchmark json')
+    warmup_parser.add_argument('benchmark', help='The benchmark file path')
+    stats_parser = subparsers.add_parser('stats', help='Print the cache statistics')
+    for subparser in [warmup_parser, stats_parser]:
+        subparser.add_argument('--cache', default='./wikidata/entity_cache.sqlite', help='The cache file path')
+    args = parser.parse_args()
+
+    entity_cache = EntityCache(args.cache)
+    if args.command == 'warmup':
+        from qwikidata.linked_data_interface import get_entity_dict_from_api
+        warm_up(entity_cache, args.benchmark, get_entity_dict_from_api)
+    print(entity_cache.stats())
+    entity_cache.close()
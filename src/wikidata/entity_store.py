@@ -0,0 +1,136 @@
+import argparse
+import json
+import mmap
+import os
+import struct
+import zlib
+from array import array
+
+from qwikidata.json_dump import WikidataJsonDump
+
+
+class EntityStore:
+
+    DATA_FILE = 'entities.dat'
+    INDEX_FILE = 'entities.idx'
+
+    # (numeric entity id, offset in data file, record length), sorted by numeric entity id
+    _INDEX_RECORD = struct.Struct('<QQI')
+
+    def __init__(self, store_dir: str):
+        self._store_dir = store_dir
+        self._data_file = open(os.path.join(store_dir, self.DATA_FILE), 'rb')
+        self._index_file = open(os.path.join(store_dir, self.INDEX_FILE), 'rb')
+        self._data = self._mmap(self._data_file)
+        self._index = self._mmap(self._index_file)
+        self._size = len(self._index) // self._INDEX_RECORD.size if self._index is not None else 0
+
+    @staticmethod
+    def _mmap(f):
+        if os.fstat(f.fileno()).st_size == 0:
+            return None
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    @staticmethod
+    def _numeric_id(ent_id):
+        if not isinstance(ent_id, str) or len(ent_id) < 2 or ent_id[0] != 'Q' or not ent_id[1:].isdigit():
+            return None
+        return int(ent_id[1:])
+
+    def _find(self, numeric_id: int):
+        low, high = 0, self._size - 1
+        while low <= high:
+            middle = (low + high) // 2
+            curr_id, offset, length = self._INDEX_RECORD.unpack_from(self._index, middle * self._INDEX_RECORD.size)
+            if curr_id == numeric_id:
+                return offset, length
+            if curr_id < numeric_id:
+                low = middle + 1
+            else:
+                high = middle - 1
+        return None
+
+    def get(self, ent_id: str):
+        numeric_id = self._numeric_id(ent_id)
+        if numeric_id is None or self._size == 0:
+            return None
+        location = self._find(numeric_id)
+        if location is None:
+            return None
+        offset, length = location
+        return json.loads(zlib.decompress(self._data[offset:offset + length]))
+
+    def __contains__(self, ent_id):
+        numeric_id = self._numeric_id(ent_id)
+        return numeric_id is not None and self._size > 0 and self._find(numeric_id) is not None
+
+    def __len__(self):
+        return self._size
+
+    def close(self):
+        for mapped in [self._data, self._index]:
+            if mapped is not None:
+                mapped.close()
+        self._data_file.close()
+        self._index_file.close()
+
+    @staticmethod
+    def compact_entity_dict(entity_dict: dict, languages=('en',)):
+        def filter_languages(d):
+            return {lang: value for lang, value in d.items() if lang in languages}
+
+        claims = dict()
+        for relation_id, relation_claims in entity_dict.get('claims', {}).items():
+            claims[relation_id] = [{key: value for key, value in claim.items() if key != 'references'}
+                                   for claim in relation_claims]
+
+        return {
+            'type': entity_dict['type'],
+            'id': entity_dict['id'],
+            'labels': filter_languages(entity_dict.get('labels', {})),
+            'descriptions': filter_languages(entity_dict.get('descriptions', {})),
+            'aliases': filter_languages(entity_dict.get('aliases', {})),
+            'claims': claims,
+            'sitelinks': {},
+        }
+
+    @staticmethod
+    def build(entity_dicts, store_dir: str, languages=('en',), log_every: int = 100000):
+        os.makedirs(store_dir, exist_ok=True)
+        ids, offsets, lengths = array('Q'), array('Q'), array('I')
+        offset = 0
+        with open(os.path.join(store_dir, EntityStore.DATA_FILE), 'wb') as data_file:
+            for i, entity_dict in enumerate(entity_dicts):
+                if entity_dict.get('type') != 'item':
+                    continue
+                numeric_id = EntityStore._numeric_id(entity_dict.get('id'))
+                if numeric_id is None:
+                    continue
+                compact_dict = EntityStore.compact_entity_dict(entity_dict, languages)
+                record = zlib.compress(json.dumps(compact_dict, ensure_ascii=False, separators=(',', ':')).encode('utf-8'))
+                data_file.write(record)
+                ids.append(numeric_id)
+                offsets.append(offset)
+                lengths.append(len(record))
+                offset += len(record)
+                if (i + 1) % log_every == 0:
+                    print(f'Stored {len(ids)} entities')
+
+        order = sorted(range(len(ids)), key=ids.__getitem__)
+        with open(os.path.join(store_dir, EntityStore.INDEX_FILE), 'wb') as index_file:
+            for i in order:
+                index_file.write(EntityStore._INDEX_RECORD.pack(ids[i], offsets[i], lengths[i]))
+        print(f'Built entity store with {len(ids)} entities at {store_dir}')
+
+    @staticmethod
+    def build_from_dump(dump_path: str, store_dir: str, languages=('en',)):
+        EntityStore.build(WikidataJsonDump(dump_path), store_dir, languages)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('dump', help='The Wikidata JSON dump path (.json, .json.gz or .json.bz2)')
+    parser.add_argument('--output', default='./wikidata/entity_store', help='The entity store directory')
+    parser.add_argument('--languages', nargs='*', default=['en'], help='The label languages to keep')
+    args = parser.parse_args()
+    EntityStore.build_from_dump(args.dump, args.output, tuple(args.languages))
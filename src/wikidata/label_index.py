@@ -0,0 +1,90 @@
+import argparse
+import json
+import mmap
+import os
+import struct
+import zipfile
+
+
+class LabelIndex:
+
+    # Layout: magic, number of entries n, n + 1 entry offsets into the entries blob, and the entries blob.
+    # Every entry is '<label>\0<entity id>' encoded as utf-8, and entries are sorted by their label bytes.
+    _MAGIC = b'RELBL001'
+    _HEADER = struct.Struct('<8sQ')
+    _OFFSET = struct.Struct('<Q')
+
+    def __init__(self, path: str):
+        self._path = path
+        self._file = open(path, 'rb')
+        self._data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self._size = self._HEADER.unpack_from(self._data, 0)
+        if magic != self._MAGIC:
+            raise ValueError(f'{path} is not a label index')
+        self._blob_start = self._HEADER.size + (self._size + 1) * self._OFFSET.size
+
+    def _entry_bounds(self, i: int):
+        start, end = struct.unpack_from('<QQ', self._data, self._HEADER.size + i * self._OFFSET.size)
+        return self._blob_start + start, self._blob_start + end
+
+    def get(self, label: str):
+        if not isinstance(label, str):
+            return None
+        key = label.encode('utf-8')
+        low, high = 0, self._size - 1
+        while low <= high:
+            middle = (low + high) // 2
+            start, end = self._entry_bounds(middle)
+            separator = self._data.find(b'\0', start, end)
+            curr_key = self._data[start:separator]
+            if curr_key == key:
+                return self._data[separator + 1:end].decode('utf-8')
+            if curr_key < key:
+                low = middle + 1
+            else:
+                high = middle - 1
+        return None
+
+    def __contains__(self, label):
+        return self.get(label) is not None
+
+    def __len__(self):
+        return self._size
+
+    def close(self):
+        self._data.close()
+        self._file.close()
+
+    @staticmethod
+    def build(label2id: dict, path: str):
+        entries = sorted((label.encode('utf-8'), str(ent_id).encode('utf-8'))
+                         for label, ent_id in label2id.items() if '\0' not in label)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(LabelIndex._HEADER.pack(LabelIndex._MAGIC, len(entries)))
+            offset = 0
+            f.write(LabelIndex._OFFSET.pack(offset))
+            for label, ent_id in entries:
+                offset += len(label) + 1 + len(ent_id)
+                f.write(LabelIndex._OFFSET.pack(offset))
+            for label, ent_id in entries:
+                f.write(label + b'\0' + ent_id)
+        os.replace(tmp_path, path)
+        print(f'Built label index with {len(entries)} labels at {path}')
+
+    @staticmethod
+    def build_from_zip(zip_path: str, path: str):
+        # Reads the json straight out of the archive, without extracting it to disk
+        with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+            member = [name for name in zip_ref.namelist() if name.endswith('.json')][0]
+            with zip_ref.open(member) as f:
+                label2id = json.load(f)
+        LabelIndex.build(label2id, path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--zip', default='./wikidata/ent_label2id.json.zip', help='The zipped label to id json')
+    parser.add_argument('--output', default='./wikidata/ent_label2id.idx', help='The label index path')
+    args = parser.parse_args()
+    LabelIndex.build_from_zip(args.zip, args.output)
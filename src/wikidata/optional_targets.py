@@ -0,0 +1,109 @@
+import argparse
+import json
+import mmap
+import os
+import random
+import struct
+
+
+# Written by create_relation2optional_targets.py and read when building the fake edits benchmark
+OPTIONAL_TARGETS_JSON_PATH = './wikidata/relation2optional_targets_new.json'
+OPTIONAL_TARGETS_INDEX_PATH = './wikidata/relation2optional_targets_new.idx'
+
+
+class OptionalTargetsIndex:
+
+    # Layout: magic, header length, json header {relation: [first entry, number of entries]},
+    # total number of entries n, n + 1 entry offsets into the targets blob, and the targets blob (utf-8)
+    _MAGIC = b'REOPT001'
+    _PREFIX = struct.Struct('<8sQ')
+    _OFFSET = struct.Struct('<Q')
+
+    def __init__(self, path: str):
+        self._path = path
+        self._file = open(path, 'rb')
+        self._data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, header_length = self._PREFIX.unpack_from(self._data, 0)
+        if magic != self._MAGIC:
+            raise ValueError(f'{path} is not an optional targets index')
+        header_start = self._PREFIX.size
+        self._relations = json.loads(self._data[header_start:header_start + header_length].decode('utf-8'))
+        self._offsets_start = header_start + header_length + self._OFFSET.size
+        self._size, = self._OFFSET.unpack_from(self._data, header_start + header_length)
+        self._blob_start = self._offsets_start + (self._size + 1) * self._OFFSET.size
+
+    def __contains__(self, relation: str):
+        return relation in self._relations
+
+    def relations(self):
+        return list(self._relations.keys())
+
+    def targets_count(self, relation: str):
+        if relation not in self._relations:
+            return 0
+        return self._relations[relation][1]
+
+    def _entry(self, i: int):
+        start, end = struct.unpack_from('<QQ', self._data, self._offsets_start + i * self._OFFSET.size)
+        return self._data[self._blob_start + start:self._blob_start + end].decode('utf-8')
+
+    def sample(self, relation: str, rng=random):
+        if relation not in self._relations:
+            return None
+        first, count = self._relations[relation]
+        if count == 0:
+            return None
+        return self._entry(first + rng.randrange(count))
+
+    def targets(self, relation: str):
+        if relation not in self._relations:
+            return []
+        first, count = self._relations[relation]
+        return [self._entry(i) for i in range(first, first + count)]
+
+    def close(self):
+        self._data.close()
+        self._file.close()
+
+    @staticmethod
+    def build(relation2optional_targets: dict, path: str):
+        relations = dict()
+        encoded_targets = []
+        for relation, targets in relation2optional_targets.items():
+            relations[relation] = [len(encoded_targets), len(targets)]
+            encoded_targets.extend(str(target).encode('utf-8') for target in targets)
+        header = json.dumps(relations, ensure_ascii=False).encode('utf-8')
+
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(OptionalTargetsIndex._PREFIX.pack(OptionalTargetsIndex._MAGIC, len(header)))
+            f.write(header)
+            f.write(OptionalTargetsIndex._OFFSET.pack(len(encoded_targets)))
+            offset = 0
+            f.write(OptionalTargetsIndex._OFFSET.pack(offset))
+            for target in encoded_targets:
+                offset += len(target)
+                f.write(OptionalTargetsIndex._OFFSET.pack(offset))
+            for target in encoded_targets:
+                f.write(target)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def load(path: str, json_path: str = None):
+        if not os.path.isfile(path):
+            if json_path is None:
+                raise FileNotFoundError(path)
+            print(f'Converting {json_path} to an optional targets index at {path}')
+            with open(json_path, 'r', encoding='utf-8') as f:
+                OptionalTargetsIndex.build(json.load(f), path)
+        return OptionalTargetsIndex(path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--json', default=OPTIONAL_TARGETS_JSON_PATH,
+                        help='The relation to optional targets json')
+    parser.add_argument('--output', default=OPTIONAL_TARGETS_INDEX_PATH,
+                        help='The optional targets index path')
+    args = parser.parse_args()
+    OptionalTargetsIndex.load(args.output, args.json)
@@ -2,6 +2,7 @@ import sys
 import random
 from wikidata.relations import our_relations
 from wikidata.utils import write_json
+from wikidata.sparql_client import AsyncSparqlClient
 from qwikidata.sparql import (get_subclasses_of_item,
                               return_sparql_query_results)
 from qwikidata.json_dump import WikidataJsonDump
@@ -60,13 +61,8 @@ def recently_modified_facts_given_relation(relation_id: str, k_recent_days: int
     return sparkql_res_to_list_of_facts(res, relation_id)
 
 
-def specific_dates_range_modified_facts_given_relation(
-        relation_id: str,
-        start_in_days_ago: int = 0,
-        end_in_days_ago: int = 1,
-        limit: int = 100
-):
-    sparql_query = f"""
+def specific_dates_range_query(relation_id: str, start_in_days_ago: int = 0, end_in_days_ago: int = 1, limit: int = 100):
+    return f"""
     SELECT DISTINCT ?item ?target ?date_modified
     WHERE
     {{
@@ -82,6 +78,15 @@ def specific_dates_range_modified_facts_given_relation(
     LIMIT {limit}
     """
 
+
+def specific_dates_range_modified_facts_given_relation(
+        relation_id: str,
+        start_in_days_ago: int = 0,
+        end_in_days_ago: int = 1,
+        limit: int = 100
+):
+    sparql_query = specific_dates_range_query(relation_id, start_in_days_ago, end_in_days_ago, limit)
+
     try:
         res = return_sparql_query_results(sparql_query)
     except:
@@ -100,15 +105,32 @@ def sample_uniformly_from_recent_days(relation_id: str, k_recent_days: int = 120
 
 
 def construct_uniformly_from_recent_days_recently_modified_dataset(k_recent_days: int = 120,
-                                                                   amount_from_each_day: int = 1):
+                                                                   amount_from_each_day: int = 1,
+                                                                   concurrency: int = 4,
+                                                                   progress_path: str = None):
+    client = AsyncSparqlClient(concurrency=concurrency, progress_path=progress_path)
+    relation_days = [(relation_name, relation_id, i)
+                     for relation_name, relation_id in our_relations.items() for i in range(k_recent_days)]
+    queries = [specific_dates_range_query(relation_id, start_in_days_ago=i, end_in_days_ago=i+1, limit=100)
+               for _, relation_id, i in relation_days]
+    print(f'Fetching {len(queries)} SPARQL queries ({client.cached_results()} already cached)...')
+    results = client.run(queries)
+
     dataset = []
-    for relation_name, relation_id in our_relations.items():
-        print(f'Processing {relation_name}...')
-        dataset.extend(sample_uniformly_from_recent_days(relation_id, k_recent_days, amount_from_each_day))
+    for (relation_name, relation_id, i), res in zip(relation_days, results):
+        if i == 0:
+            print(f'Processing {relation_name}...')
+        if res is None:
+            continue
+        current_possible_facts = sparkql_res_to_list_of_facts(res, relation_id)
+        dataset.extend(random.sample(current_possible_facts, min(amount_from_each_day, len(current_possible_facts))))
     return dataset
 
 
 if __name__ == '__main__':
-    dataset = construct_uniformly_from_recent_days_recently_modified_dataset(k_recent_days=250, amount_from_each_day=4)
+    dataset = construct_uniformly_from_recent_days_recently_modified_dataset(
+        k_recent_days=250, amount_from_each_day=4, concurrency=4,
+        progress_path='../generations/recently_modified_sparql_progress.jsonl'
+    )
     print(len(dataset))
     write_json(dataset, '../generations/uniformly_from_recent_days_recently_modified_dataset.json')
@@ -0,0 +1,70 @@
+import argparse
+import json
+import os
+import sqlite3
+import threading
+
+from wikidata.shard_index import FILTERED_RELATIONS_DIR, list_shards
+
+
+class ReverseIndex:
+
+    INDEX_FILE = 'reverse_index.sqlite'
+
+    def __init__(self, wikidata_dir: str):
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(os.path.join(wikidata_dir, self.INDEX_FILE), check_same_thread=False)
+
+    @staticmethod
+    def exists(wikidata_dir: str):
+        return os.path.isfile(os.path.join(wikidata_dir, ReverseIndex.INDEX_FILE))
+
+    def subjects(self, target: str, relation_id: str, limit: int = None):
+        with self._lock:
+            rows = self._connection.execute(
+                'SELECT DISTINCT subject FROM edges WHERE target = ? AND relation = ? LIMIT ?',
+                (target, relation_id, -1 if limit is None else limit)
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+    @staticmethod
+    def build(wikidata_dir: str):
+        # Imported here since wikidata.relations depends on wikidata.utils, which depends on this module
+        from wikidata.relations import our_relations
+
+        index_path = os.path.join(wikidata_dir, ReverseIndex.INDEX_FILE)
+        if os.path.exists(index_path):
+            os.remove(index_path)
+        connection = sqlite3.connect(index_path)
+        connection.execute('PRAGMA journal_mode=OFF')
+        connection.execute('PRAGMA synchronous=OFF')
+        connection.execute('CREATE TABLE edges (target TEXT, relation TEXT, subject TEXT)')
+        shard_paths = list_shards(wikidata_dir)
+        for i, path in enumerate(shard_paths):
+            print(f'{i + 1}/{len(shard_paths)}')
+            with open(path, 'r', encoding='utf-8') as f:
+                curr_part = json.load(f)
+            connection.executemany('INSERT INTO edges VALUES (?, ?, ?)',
+                                   ((target, our_relations[relation], subject)
+                                    for subject, facts in curr_part.items()
+                                    for relation, target in facts
+                                    if relation in our_relations and isinstance(target, str)))
+            connection.commit()
+        print('Creating the (target, relation) index')
+        connection.execute('CREATE INDEX edges_target_relation ON edges (target, relation)')
+        connection.commit()
+        count = connection.execute('SELECT COUNT(*) FROM edges').fetchone()[0]
+        connection.close()
+        print(f'Indexed {count} edges from {len(shard_paths)} shards')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--wikidata-dir', default=FILTERED_RELATIONS_DIR,
+                        help='The filtered relations shards directory')
+    args = parser.parse_args()
+    ReverseIndex.build(args.wikidata_dir)
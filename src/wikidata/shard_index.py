@@ -0,0 +1,122 @@
+import argparse
+import json
+import os
+import re
+import sqlite3
+import threading
+
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+# The filtered relations shards, resolved against this package so the indexes and the lookups find the same
+# directory whatever the working directory is
+FILTERED_RELATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'wikidata_full_kg',
+                                      'filtered_relations')
+
+
+def list_shards(wikidata_dir: str):
+    return [os.path.join(wikidata_dir, file) for file in os.listdir(wikidata_dir) if file[-5:] == '.json']
+
+
+def iter_shard_records(path: str):
+    # Yields (entity, value offset, value length) for every top level entry of a shard, offsets are in bytes.
+    # The shard is scanned as latin-1 so that string offsets are byte offsets; JSON structural characters are
+    # all ascii so the scan is not affected by multi-byte utf-8 sequences, which are decoded properly afterwards.
+    with open(path, 'rb') as f:
+        raw = f.read()
+    text = raw.decode('latin-1')
+    decoder = json.JSONDecoder()
+
+    pos = _WHITESPACE.match(text, 0).end()
+    if pos == len(text) or text[pos] != '{':
+        raise ValueError(f'{path} is not a json object')
+    pos = _WHITESPACE.match(text, pos + 1).end()
+    while text[pos] != '}':
+        _, key_end = decoder.raw_decode(text, pos)
+        key = json.loads(raw[pos:key_end].decode('utf-8'))
+        pos = _WHITESPACE.match(text, key_end).end()
+        if text[pos] != ':':
+            raise ValueError(f'Expected ":" at offset {pos} of {path}')
+        pos = _WHITESPACE.match(text, pos + 1).end()
+        _, value_end = decoder.raw_decode(text, pos)
+        yield key, pos, value_end - pos
+        pos = _WHITESPACE.match(text, value_end).end()
+        if text[pos] == ',':
+            pos = _WHITESPACE.match(text, pos + 1).end()
+
+
+class ShardIndex:
+
+    INDEX_FILE = 'shard_index.sqlite'
+
+    def __init__(self, wikidata_dir: str):
+        self._wikidata_dir = wikidata_dir
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(os.path.join(wikidata_dir, self.INDEX_FILE), check_same_thread=False)
+        self._shard_paths = dict(self._connection.execute('SELECT id, path FROM shards').fetchall())
+        self._shard_files = dict()
+
+    @staticmethod
+    def exists(wikidata_dir: str):
+        return os.path.isfile(os.path.join(wikidata_dir, ShardIndex.INDEX_FILE))
+
+    def _shard_file(self, shard_id: int):
+        if shard_id not in self._shard_files:
+            self._shard_files[shard_id] = open(os.path.join(self._wikidata_dir, self._shard_paths[shard_id]), 'rb')
+        return self._shard_files[shard_id]
+
+    def lookup(self, ent: str):
+        with self._lock:
+            row = self._connection.execute('SELECT shard, offset, length FROM records WHERE entity = ?',
+                                           (ent,)).fetchone()
+            if row is None:
+                return None
+            shard_id, offset, length = row
+            f = self._shard_file(shard_id)
+            f.seek(offset)
+            raw = f.read(length)
+        return json.loads(raw.decode('utf-8'))
+
+    def __contains__(self, ent):
+        with self._lock:
+            return self._connection.execute('SELECT 1 FROM records WHERE entity = ?', (ent,)).fetchone() is not None
+
+    def entities(self):
+        with self._lock:
+            return [row[0] for row in self._connection.execute('SELECT entity FROM records').fetchall()]
+
+    def close(self):
+        with self._lock:
+            for f in self._shard_files.values():
+                f.close()
+            self._connection.close()
+
+    @staticmethod
+    def build(wikidata_dir: str):
+        index_path = os.path.join(wikidata_dir, ShardIndex.INDEX_FILE)
+        if os.path.exists(index_path):
+            os.remove(index_path)
+        connection = sqlite3.connect(index_path)
+        connection.execute('CREATE TABLE shards (id INTEGER PRIMARY KEY, path TEXT)')
+        connection.execute('CREATE TABLE records '
+                            '(entity TEXT PRIMARY KEY, shard INTEGER, offset INTEGER, length INTEGER) WITHOUT ROWID')
+        shard_paths = list_shards(wikidata_dir)
+        for shard_id, path in enumerate(shard_paths):
+            print(f'{shard_id + 1}/{len(shard_paths)}')
+            connection.execute('INSERT INTO shards VALUES (?, ?)', (shard_id, os.path.basename(path)))
+            # The first shard containing an entity wins, as in a linear scan over the shards
+            connection.executemany('INSERT OR IGNORE INTO records VALUES (?, ?, ?, ?)',
+                                   ((ent, shard_id, offset, length)
+                                    for ent, offset, length in iter_shard_records(path)))
+            connection.commit()
+        count = connection.execute('SELECT COUNT(*) FROM records').fetchone()[0]
+        connection.close()
+        print(f'Indexed {count} entities from {len(shard_paths)} shards')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--wikidata-dir', default=FILTERED_RELATIONS_DIR,
+                        help='The filtered relations shards directory')
+    args = parser.parse_args()
+    ShardIndex.build(args.wikidata_dir)
@@ -0,0 +1,114 @@
+import asyncio
+import json
+import os
+import time
+
+import requests
+
+
+WIKIDATA_SPARQL_URL = 'https://query.wikidata.org/sparql'
+WIKIDATA_USER_AGENT = 'RippleEdits (https://github.com/edenbiran/RippleEdits)'
+
+
+class AsyncSparqlClient:
+
+    def __init__(self,
+                 endpoint: str = WIKIDATA_SPARQL_URL,
+                 concurrency: int = 4,
+                 requests_per_second: float = 5.0,
+                 max_retries: int = 5,
+                 backoff: float = 2.0,
+                 timeout: float = 60,
+                 progress_path: str = None):
+        self._endpoint = endpoint
+        self._concurrency = concurrency
+        self._min_interval = 1.0 / requests_per_second if requests_per_second else 0.0
+        self._max_retries = max_retries
+        self._backoff = backoff
+        self._timeout = timeout
+        self._progress_path = progress_path
+        self._cache = dict()
+        self._next_request_time = 0.0
+        if progress_path is not None:
+            os.makedirs(os.path.dirname(os.path.abspath(progress_path)), exist_ok=True)
+            if os.path.isfile(progress_path):
+                self._load_progress(progress_path)
+
+    def _load_progress(self, path: str):
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # A partially written last line from an interrupted run
+                self._cache[entry['query']] = entry['result']
+        print(f'Loaded {len(self._cache)} cached SPARQL results from {path}')
+
+    def _record(self, query: str, result: dict):
+        self._cache[query] = result
+        if self._progress_path is not None:
+            with open(self._progress_path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps({'query': query, 'result': result}, ensure_ascii=False) + '\n')
+
+    def _get(self, query: str):
+        return requests.get(self._endpoint,
+                            params={'query': query, 'format': 'json'},
+                            headers={'User-Agent': WIKIDATA_USER_AGENT, 'Accept': 'application/sparql-results+json'},
+                            timeout=self._timeout)
+
+    async def _wait_for_rate_limit(self, lock: asyncio.Lock):
+        async with lock:
+            now = time.monotonic()
+            delay = self._next_request_time - now
+            self._next_request_time = max(now, self._next_request_time) + self._min_interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def _retry_delay(self, attempt: int, response=None):
+        if response is not None and response.headers.get('Retry-After', '').isdigit():
+            return float(response.headers['Retry-After'])
+        return self._backoff * (2 ** attempt)
+
+    async def _fetch(self, query: str, semaphore: asyncio.Semaphore, lock: asyncio.Lock):
+        if query in self._cache:
+            return self._cache[query]
+        for attempt in range(self._max_retries + 1):
+            response = None
+            async with semaphore:
+                await self._wait_for_rate_limit(lock)
+                try:
+                    response = await asyncio.to_thread(self._get, query)
+                    if response.status_code == 200:
+                        result = response.json()
+                        self._record(query, result)
+                        return result
+                    if response.status_code != 429 and response.status_code < 500:
+                        print(f'SPARQL query failed with status {response.status_code}')
+                        return None
+                except (requests.RequestException, ValueError) as e:
+                    print(f'SPARQL query failed: {e}')
+            if attempt < self._max_retries:
+                await asyncio.sleep(self._retry_delay(attempt, response))
+        print(f'SPARQL query failed after {self._max_retries + 1} attempts')
+        return None
+
+    async def fetch_all(self, queries: list, log_every: int = 100):
+        semaphore = asyncio.Semaphore(self._concurrency)
+        lock = asyncio.Lock()
+        done = 0
+
+        async def fetch_and_log(query):
+            nonlocal done
+            result = await self._fetch(query, semaphore, lock)
+            done += 1
+            if done % log_every == 0:
+                print(f'{done}/{len(queries)} SPARQL queries done')
+            return result
+
+        return await asyncio.gather(*[fetch_and_log(query) for query in queries])
+
+    def run(self, queries: list):
+        return asyncio.run(self.fetch_all(queries))
+
+    def cached_results(self):
+        return len(self._cache)
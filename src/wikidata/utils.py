@@ -2,11 +2,30 @@ import json
 import csv
 import os
 import functools
+import sqlite3
 from collections import defaultdict
 from qwikidata.linked_data_interface import get_entity_dict_from_api
 from qwikidata.entity import WikidataItem
 from qwikidata.sparql import return_sparql_query_results
-import zipfile
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from wikidata.entity_store import EntityStore
+from wikidata.entity_cache import EntityCache, is_entity_id
+from wikidata.shard_index import FILTERED_RELATIONS_DIR, ShardIndex, list_shards
+from wikidata.label_index import LabelIndex
+from wikidata.reverse_index import ReverseIndex
+from wikidata.sparql_client import WIKIDATA_USER_AGENT
+
+
+ENTITY_STORE_DIR = './wikidata/entity_store'
+ENTITY_CACHE_PATH = './wikidata/entity_cache.sqlite'
+ENTITY_CACHE_MAX_ENTRIES = 1000000
+ENTITY_CACHE_TTL = 30 * 24 * 60 * 60
+ITEM_MEMORY_CACHE_SIZE = 100000
+ENT_LABEL2ID_ZIP_PATH = './wikidata/ent_label2id.json.zip'
+ENT_LABEL2ID_INDEX_PATH = './wikidata/ent_label2id.idx'
+REVERSE_INDEX_SPARQL_FALLBACK = False
+WIKIDATA_API_URL = 'https://www.wikidata.org/w/api.php'
 
 
 def load_json(path: str):
@@ -47,15 +66,23 @@ def read_from_csv(path: str):
     return table
 
 
-def retrieve_from_wikidata(ent: str, wikidata_dir: str = './wikidata_full_kg/filtered_relations'):
+_shard_indexes = dict()
+
+
+def get_shard_index(wikidata_dir: str):
+    if wikidata_dir not in _shard_indexes:
+        _shard_indexes[wikidata_dir] = ShardIndex(wikidata_dir) if ShardIndex.exists(wikidata_dir) else None
+    return _shard_indexes[wikidata_dir]
+
+
+def retrieve_from_wikidata(ent: str, wikidata_dir: str = FILTERED_RELATIONS_DIR):
     if not ent:
         return None
-    relevant_files = []
-    for file in os.listdir(wikidata_dir):
-        if file[-5:] == '.json':
-            relevant_files.append(os.path.join(wikidata_dir, file))
+    shard_index = get_shard_index(wikidata_dir)
+    if shard_index is not None:
+        return shard_index.lookup(ent)
 
-    for path in relevant_files:
+    for path in list_shards(wikidata_dir):
         curr_part = load_json(path)
         if ent in curr_part:
             return curr_part[ent]
@@ -69,14 +96,116 @@ def facts_list_to_relation2targets(facts: list):
     return relation2targets
 
 
-@functools.lru_cache()
+_entity_store = None
+
+
+def get_entity_store():
+    global _entity_store
+    if _entity_store is None:
+        if os.path.isfile(os.path.join(ENTITY_STORE_DIR, EntityStore.INDEX_FILE)):
+            _entity_store = EntityStore(ENTITY_STORE_DIR)
+        else:
+            _entity_store = False
+    return _entity_store or None
+
+
+_entity_cache = None
+
+
+def get_entity_cache():
+    global _entity_cache
+    if _entity_cache is None:
+        try:
+            _entity_cache = EntityCache(ENTITY_CACHE_PATH, ENTITY_CACHE_MAX_ENTRIES, ENTITY_CACHE_TTL)
+        except sqlite3.Error:
+            _entity_cache = False
+    return _entity_cache or None
+
+
+def entity_cache_stats():
+    entity_cache = get_entity_cache()
+    stats = entity_cache.stats() if entity_cache is not None else dict()
+    stats['memory'] = wikidata_item_given_id.cache_info()._asdict()
+    return stats
+
+
+def entity_dict_given_id(ent_id: str):
+    entity_store = get_entity_store()
+    if entity_store is not None:
+        return entity_store.get(ent_id)
+    entity_cache = get_entity_cache()
+    if entity_cache is not None:
+        entity_dict = entity_cache.get(ent_id)
+        if entity_dict is not None:
+            return entity_dict
+    if ent_id in _prefetched_entity_dicts:
+        return _prefetched_entity_dicts.pop(ent_id)
+    entity_dict = get_entity_dict_from_api(ent_id)
+    if entity_cache is not None:
+        entity_cache.put(ent_id, entity_dict)
+    return entity_dict
+
+
+@functools.lru_cache(maxsize=ITEM_MEMORY_CACHE_SIZE)
 def wikidata_item_given_id(ent_id: str):
     try:
-        return WikidataItem(get_entity_dict_from_api(ent_id))
+        return WikidataItem(entity_dict_given_id(ent_id))
     except:
         return None
 
 
+_prefetched_entity_dicts = dict()
+
+
+def fetch_entity_dicts(ent_ids: list, api_url: str = WIKIDATA_API_URL, timeout: float = 60):
+    response = requests.get(api_url, params={
+        'action': 'wbgetentities',
+        'ids': '|'.join(ent_ids),
+        'format': 'json',
+    }, headers={'User-Agent': WIKIDATA_USER_AGENT}, timeout=timeout)
+    response.raise_for_status()
+    result = response.json()
+    if 'error' in result:
+        raise Exception(result['error'])
+    entity_dicts = dict()
+    for ent_id, entity_dict in result.get('entities', {}).items():
+        if 'missing' in entity_dict:
+            continue
+        # Redirected entities are returned under the id they redirect to
+        requested_id = entity_dict.get('redirects', {}).get('from', ent_id)
+        entity_dicts[requested_id] = entity_dict
+    return entity_dicts
+
+
+def prefetch_entities(ent_ids, batch_size: int = 50, max_workers: int = 4, api_url: str = WIKIDATA_API_URL):
+    if get_entity_store() is not None:
+        return 0
+    ent_ids = sorted(set(ent_id for ent_id in ent_ids if is_entity_id(ent_id)))
+    entity_cache = get_entity_cache()
+    if entity_cache is not None:
+        ent_ids = entity_cache.missing_ids(ent_ids)
+    else:
+        ent_ids = [ent_id for ent_id in ent_ids if ent_id not in _prefetched_entity_dicts]
+    batches = [ent_ids[i:i + batch_size] for i in range(0, len(ent_ids), batch_size)]
+
+    def fetch_batch(batch):
+        try:
+            return fetch_entity_dicts(batch, api_url)
+        except Exception as e:
+            print(f'Failed fetching a batch of {len(batch)} entities: {e}')
+            return dict()
+
+    fetched = 0
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for entity_dicts in executor.map(fetch_batch, batches):
+            if entity_cache is not None:
+                entity_cache.put_many(entity_dicts)
+            else:
+                _prefetched_entity_dicts.update(entity_dicts)
+            fetched += len(entity_dicts)
+    return fetched
+
+
 def get_label(ent_id: str):
     if isinstance(ent_id, list):
         if len(ent_id) > 0:
@@ -158,16 +287,20 @@ def ent_to_relation_ids(ent_id: str):
     return list(related_claims.keys())
 
 
-with zipfile.ZipFile('./wikidata/ent_label2id.json.zip', 'r') as zip_ref:
-    zip_ref.extractall('./wikidata/ent_label2id.json')
+_ent_label2id_index = None
+
 
-ent_label2id_dict = load_json('./wikidata/ent_label2id.json')
+def get_ent_label2id_index():
+    global _ent_label2id_index
+    if _ent_label2id_index is None:
+        if not os.path.isfile(ENT_LABEL2ID_INDEX_PATH):
+            LabelIndex.build_from_zip(ENT_LABEL2ID_ZIP_PATH, ENT_LABEL2ID_INDEX_PATH)
+        _ent_label2id_index = LabelIndex(ENT_LABEL2ID_INDEX_PATH)
+    return _ent_label2id_index
 
 
 def ent_label2id(label: str):
-    if label not in ent_label2id_dict:
-        return None
-    return ent_label2id_dict[label]
+    return get_ent_label2id_index().get(label)
 
 
 def extract_ent_id_from_url(url: str):
@@ -215,7 +348,17 @@ def sparkql_res_to_list_of_entities(sparkql_res: dict):
     return resulted_entities
 
 
-def subjects_given_relation_target(relation_id: str, target_id: str, limit: int = 10):
+_reverse_index = None
+
+
+def get_reverse_index():
+    global _reverse_index
+    if _reverse_index is None:
+        _reverse_index = ReverseIndex(FILTERED_RELATIONS_DIR) if ReverseIndex.exists(FILTERED_RELATIONS_DIR) else False
+    return _reverse_index or None
+
+
+def subjects_given_relation_target_sparql(relation_id: str, target_id: str, limit: int = 10):
     sparql_query = f"""
     SELECT DISTINCT ?item ?itemLabel 
     WHERE
@@ -232,3 +375,17 @@ def subjects_given_relation_target(relation_id: str, target_id: str, limit: int
     except:
         return []
 
+
+def subjects_given_relation_target(relation_id: str, target_id: str, limit: int = 10, sparql_fallback: bool = None):
+    # Without sparql_fallback, REVERSE_INDEX_SPARQL_FALLBACK decides whether SPARQL is queried when the reverse index
+    # has no subjects
+    if sparql_fallback is None:
+        sparql_fallback = REVERSE_INDEX_SPARQL_FALLBACK
+    reverse_index = get_reverse_index()
+    if reverse_index is None:
+        return subjects_given_relation_target_sparql(relation_id, target_id, limit)
+    # The filtered relations shards are keyed by labels, so are the subjects returned (as with the SPARQL labels)
+    subjects = reverse_index.subjects(get_label(target_id), relation_id, limit)
+    if not subjects and sparql_fallback:
+        return subjects_given_relation_target_sparql(relation_id, target_id, limit)
+    return subjects